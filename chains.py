@@ -1,19 +1,270 @@
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain_community.chat_models import ChatOpenAI
-from langchain.schema import BaseRetriever
-from typing import Optional, Dict, Any
+from langchain_community.cache import SQLiteCache
+from langchain.schema import BaseRetriever, Document
+from embeddings import get_http_client, HTTP_LIMITS
+from openai import OpenAI, AsyncOpenAI
+from langchain.callbacks.base import BaseCallbackHandler
+from langchain.callbacks.manager import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun
+)
+from collections import OrderedDict
+from concurrent.futures import Future
+from contextvars import ContextVar
+from typing import Optional, Dict, Any, List, Tuple, Callable, Union
+import numpy as np
+import httpx
+import asyncio
+import queue
+import contextlib
+import functools
+import threading
+import time
 import os
+import weakref
 import logging
 
 logger = logging.getLogger(__name__)
 
+# With RAG_LLM_CACHE=1, the RAG chat model serves completions of prompts seen
+# before (the same question over the same context) from this database
+LLM_CACHE_PATH = os.path.join("models", "rag_llm_cache.db")
+
+@functools.lru_cache(maxsize=1)
+def _llm_cache() -> SQLiteCache:
+    """The RAG chat model's completion cache, opened once per process."""
+    os.makedirs(os.path.dirname(LLM_CACHE_PATH), exist_ok=True)
+    return SQLiteCache(database_path=LLM_CACHE_PATH)
+
+# Stage timings of the query being run in this thread or task
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+@contextlib.contextmanager
+def timed(label: str, timings: Dict[str, float]):
+    """Record the wall time of the block, in milliseconds, under timings[label]."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[label] = (time.perf_counter() - start) * 1000
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """Collects streamed LLM tokens and hands the answer so far to a callback.
+    
+    Args:
+        render (Callable[[str], None]): Called with the accumulated answer
+            after every new token, e.g. a Streamlit placeholder's markdown
+    """
+    
+    # Called directly on async runs too, so tokens arrive in order
+    run_inline = True
+    
+    def __init__(self, render: Callable[[str], None]):
+        # Not stored as on_text, which is itself a callback event
+        self.render = render
+        self.tokens: List[str] = []
+        self.first_token_at: Optional[float] = None
+    
+    def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+        self.tokens.append(token)
+        self.render("".join(self.tokens))
+    
+    def on_llm_end(self, response: Any, **kwargs: Any) -> None:
+        # Cached completions arrive whole, without streaming any tokens
+        if not self.tokens and response.generations and response.generations[0]:
+            self.first_token_at = time.perf_counter()
+            self.render(response.generations[0][0].text)
+
+@functools.lru_cache(maxsize=1)
+def _event_loop() -> asyncio.AbstractEventLoop:
+    """The process-wide event loop that batchers and async queries run on."""
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True, name="rag-event-loop").start()
+    return loop
+
+@functools.lru_cache(maxsize=1)
+def _async_http_client() -> httpx.AsyncClient:
+    """HTTP client for async chat requests, whose pool is bound to the shared loop."""
+    return httpx.AsyncClient(limits=HTTP_LIMITS)
+
+async def _drain(batcher_ref: "weakref.ref[_SearchBatcher]", queue: asyncio.Queue) -> None:
+    """Run the batches of a batcher's queue until it is closed or collected.
+    
+    Only a weak reference is held while waiting, so an unused chain's batcher,
+    and the index it searches, can be freed.
+    """
+    while True:
+        first = await queue.get()
+        batcher = batcher_ref()
+        if batcher is None:
+            return
+        await batcher._run_batch(first)
+        del batcher
+
+class _SearchBatcher:
+    """Coalesces concurrent similarity searches into batched FAISS calls.
+    
+    Queries are queued on the process-wide event loop, which runs in a
+    background thread shared by all batchers. The drain task collects up to max_batch queries, waiting at most max_wait_ms
+    after the first one, then embeds them in one request and runs a single
+    index.search over the (B, d) query matrix. Each query's future resolves
+    to its documents and the embed/search/hydrate timings of its batch.
+    
+    The documents of the last cache_size distinct queries are kept, so
+    repeated queries skip embedding and search and resolve with no timings.
+    A batcher serves one index version; chains are rebuilt when it changes.
+    """
+    
+    def __init__(self, vectorstore, k: int, max_batch: int, max_wait_ms: float, cache_size: int = 256):
+        self.vectorstore = vectorstore
+        self.k = k
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.cache_size = cache_size
+        self._results: "OrderedDict[str, List[Document]]" = OrderedDict()
+        self._results_lock = threading.Lock()
+        
+        self._loop = _event_loop()
+        asyncio.run_coroutine_threadsafe(self._start(), self._loop).result()
+        # Stop draining once the batcher is closed or garbage collected
+        self._close = weakref.finalize(self, self._loop.call_soon_threadsafe, self._drain_task.cancel)
+    
+    async def _start(self) -> None:
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._drain_task = asyncio.create_task(_drain(weakref.ref(self), self._queue))
+    
+    def close(self) -> None:
+        """Stop serving queries; pending ones are left unresolved."""
+        self._close()
+    
+    def submit(self, query: str) -> Future:
+        """Queue a query; the returned future resolves to its documents."""
+        with self._results_lock:
+            docs = self._results.get(query)
+            if docs is not None:
+                self._results.move_to_end(query)
+        if docs is not None:
+            future: Future = Future()
+            future.set_result((list(docs), {}))
+            return future
+        return asyncio.run_coroutine_threadsafe(self._enqueue(query), self._loop)
+    
+    def _remember(self, query: str, docs: List[Document]) -> None:
+        with self._results_lock:
+            self._results[query] = docs
+            self._results.move_to_end(query)
+            if len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+    
+    def run(self, coro) -> Future:
+        """Schedule a coroutine on the shared event loop."""
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+    
+    async def _enqueue(self, query: str) -> Tuple[List[Document], Dict[str, float]]:
+        future = self._loop.create_future()
+        await self._queue.put((query, future))
+        return await future
+    
+    async def _run_batch(self, first: Tuple[str, asyncio.Future]) -> None:
+        batch: List[Tuple[str, asyncio.Future]] = [first]
+        deadline = self._loop.time() + self.max_wait
+        # Dequeue only with get_nowait: wait_for(queue.get()) can drop an item
+        # dequeued just as its timeout fires, leaving that query unanswered
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - self._loop.time()
+            if timeout <= 0:
+                break
+            await asyncio.sleep(timeout)
+        
+        try:
+            results, timings = await asyncio.to_thread(self._search, [query for query, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        
+        for (query, future), docs in zip(batch, results):
+            self._remember(query, docs)
+            if not future.done():
+                future.set_result((docs, timings))
+    
+    def _search(self, queries: List[str]) -> Tuple[List[List[Document]], Dict[str, float]]:
+        vectorstore = self.vectorstore
+        timings: Dict[str, float] = {}
+        with timed("embed", timings):
+            # Queries skip the persistent document cache, through embed_queries when available
+            embedding_function = vectorstore.embedding_function
+            embed = getattr(embedding_function, "embed_queries", None)
+            vectors = embed(queries) if embed else [embedding_function.embed_query(q) for q in queries]
+            xq = np.asarray(vectors, dtype=np.float32)
+        with timed("search", timings):
+            _, indices = vectorstore.index.search(xq, self.k)
+        
+        with timed("hydrate", timings):
+            results = [
+                [vectorstore.docstore.search(vectorstore.index_to_docstore_id[i]) for i in row if i != -1]
+                for row in indices
+            ]
+        return results, timings
+
+class BatchingRetriever(BaseRetriever):
+    """Retriever that micro-batches concurrent queries into one FAISS search.
+    
+    FAISS runs single-vector searches on one thread; batching queries turns
+    many small scans into one multi-threaded, BLAS-backed search.
+    """
+    
+    vectorstore: Any
+    k: int = 4
+    max_batch: int = 32
+    max_wait_ms: float = 5.0
+    cache_size: int = 256
+    batcher: Any = None
+    
+    def __init__(self, **kwargs: Any):
+        super().__init__(**kwargs)
+        self.batcher = _SearchBatcher(
+            self.vectorstore, self.k, self.max_batch, self.max_wait_ms, self.cache_size
+        )
+    
+    def _get_relevant_documents(
+        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        timings = _request_timings.get()
+        if timings is None:
+            timings = {}
+        with timed("retrieve", timings):
+            docs, stage_timings = self.batcher.submit(query).result()
+        timings.update(stage_timings)
+        return docs
+    
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        timings = _request_timings.get()
+        if timings is None:
+            timings = {}
+        with timed("retrieve", timings):
+            docs, stage_timings = await asyncio.wrap_future(self.batcher.submit(query))
+        timings.update(stage_timings)
+        return docs
+
 def build_rag_chain(
     vectorstore: BaseRetriever,
     model_name: str = "gpt-4o-mini",
     temperature: float = 0,
     max_tokens: int = 2048,
-    k_documents: int = 4
+    k_documents: Optional[int] = None
 ) -> Optional[RetrievalQA]:
     """Build an optimized RAG chain with configurable parameters.
     
@@ -22,7 +273,8 @@ def build_rag_chain(
         model_name (str): Name of the OpenAI model to use
         temperature (float): Temperature for response generation
         max_tokens (int): Maximum tokens in response
-        k_documents (int): Number of documents to retrieve
+        k_documents (Optional[int]): Number of documents to retrieve. Defaults
+            to the RAG_TOP_K environment variable, or 4.
         
     Returns:
         Optional[RetrievalQA]: Initialized RAG chain or None if initialization fails
@@ -49,22 +301,25 @@ Please provide a detailed answer based on the context above:"""
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable not set")
             
+        # Sync requests share the embeddings' pooled connections. The clients are passed
+        # in built, since ChatOpenAI would also hand http_client to its async client.
+        # Async requests only run on the shared event loop, which their
+        # connection pool is bound to.
         llm = ChatOpenAI(
             model=model_name,
             temperature=temperature,
             max_tokens=max_tokens,
-            openai_api_key=api_key
+            openai_api_key=api_key,
+            streaming=True,
+            client=OpenAI(api_key=api_key, http_client=get_http_client()).chat.completions,
+            async_client=AsyncOpenAI(api_key=api_key, http_client=_async_http_client()).chat.completions,
+            cache=_llm_cache() if os.getenv("RAG_LLM_CACHE") == "1" else None
         )
 
-        # 3. Configure retriever
-        retriever = vectorstore.as_retriever(
-            search_type="similarity",
-            search_kwargs={
-                "k": k_documents,
-                "fetch_k": k_documents * 2,  # Fetch more docs initially for better filtering
-                "score_threshold": None  # No threshold to ensure we get results
-            }
-        )
+        # 3. Configure retriever (batches concurrent queries into one index search)
+        if k_documents is None:
+            k_documents = int(os.getenv("RAG_TOP_K", "4"))
+        retriever = BatchingRetriever(vectorstore=vectorstore, k=k_documents)
 
         # 4. Build chain
         chain = RetrievalQA.from_chain_type(
@@ -74,22 +329,18 @@ Please provide a detailed answer based on the context above:"""
             return_source_documents=True,
             chain_type_kwargs={
                 "prompt": PROMPT,
-                "verbose": True,
                 "document_separator": "\n\n"  # Clear separation between documents
             }
         )
 
-        # 5. Test chain
-        test_response = chain({"query": "test"})
-        print("Chain test response:", test_response.keys())
-
-        # Verify chain
-        if chain:
+        # 5. Verify chain (runs a full retrieval and completion, so only when debugging)
+        if os.getenv("RAG_DEBUG"):
             try:
                 test_response = chain({"query": "test"})
                 if not isinstance(test_response, dict) or "result" not in test_response:
                     logger.warning("Chain verification failed: invalid response format")
                     return None
+                logger.debug(f"Chain test response: {list(test_response.keys())}")
             except Exception as e:
                 logger.error(f"Chain verification failed: {e}")
                 return None
@@ -97,5 +348,119 @@ Please provide a detailed answer based on the context above:"""
         return chain
 
     except Exception as e:
-        print(f"Error building RAG chain: {e}")
+        logger.error(f"Error building RAG chain: {e}")
         return None
+
+def _record_timings(timings: Dict[str, float], handler: Optional[TokenStreamHandler], start: float) -> None:
+    """Derive the first-token and LLM timings of a finished query, and log them."""
+    if handler and handler.first_token_at is not None:
+        timings["first_token"] = (handler.first_token_at - start) * 1000
+    timings["llm"] = timings["total"] - timings.get("retrieve", 0.0)
+    logger.info("RAG query timings: " + " ".join(f"t_{label}_ms={ms:.1f}" for label, ms in timings.items()))
+
+def run_rag_query(
+    chain: RetrievalQA,
+    query: str,
+    on_text: Optional[Callable[[str], None]] = None
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Run a query through a RAG chain, timing each stage.
+    
+    Args:
+        chain (RetrievalQA): Chain built by build_rag_chain
+        query (str): Question to answer
+        on_text (Optional[Callable[[str], None]]): Called with the partial
+            answer as each token streams in
+        
+    Returns:
+        Tuple[Dict[str, Any], Dict[str, float]]: The chain response, and the
+            milliseconds spent in total, retrieval (with its embed, search and
+            hydrate stages, shared by the queries batched with this one), until
+            the first streamed token and in the LLM
+    """
+    timings: Dict[str, float] = {}
+    handler = TokenStreamHandler(on_text) if on_text else None
+    token = _request_timings.set(timings)
+    start = time.perf_counter()
+    try:
+        with timed("total", timings):
+            response = chain({"query": query}, callbacks=[handler] if handler else None)
+    finally:
+        _request_timings.reset(token)
+    
+    _record_timings(timings, handler, start)
+    return response, timings
+
+async def arun_rag_query(
+    chain: RetrievalQA,
+    query: str,
+    on_text: Optional[Callable[[str], None]] = None
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Async version of run_rag_query.
+    
+    Must run on the shared event loop, which the chain's async OpenAI
+    client is bound to; see submit_rag_query. on_text is called on
+    that loop.
+    """
+    timings: Dict[str, float] = {}
+    handler = TokenStreamHandler(on_text) if on_text else None
+    _request_timings.set(timings)  # Tasks run in a copy of the context
+    start = time.perf_counter()
+    with timed("total", timings):
+        response = await chain.acall({"query": query}, callbacks=[handler] if handler else None)
+    
+    _record_timings(timings, handler, start)
+    return response, timings
+
+def submit_rag_query(
+    chain: RetrievalQA,
+    query: str,
+    on_text: Optional[Callable[[str], None]] = None
+) -> Tuple[Dict[str, Any], Dict[str, float]]:
+    """Run a query on the chain's shared event loop and wait for the answer.
+    
+    Concurrent callers, e.g. one Streamlit session each, are multiplexed on
+    one loop and one pool of keep-alive connections, rather than each
+    holding a blocking request. Streamed text is relayed so on_text is
+    called on the calling thread, with the latest partial answer.
+    
+    Args and returns are as for run_rag_query.
+    """
+    updates: "queue.Queue[str]" = queue.Queue()
+    future = chain.retriever.batcher.run(
+        arun_rag_query(chain, query, on_text=updates.put if on_text else None)
+    )
+    while on_text:
+        try:
+            text = updates.get(timeout=0.05)
+        except queue.Empty:
+            if future.done():
+                break
+            continue
+        # Skip to the newest text if tokens arrived faster than they were drawn
+        while not updates.empty():
+            text = updates.get_nowait()
+        on_text(text)
+    return future.result()
+
+def submit_rag_queries(
+    chain: RetrievalQA,
+    queries: List[str]
+) -> List[Union[Tuple[Dict[str, Any], Dict[str, float]], Exception]]:
+    """Answer several queries concurrently on the chain's shared event loop.
+    
+    The completions are requested together, and their retrievals are
+    coalesced into one index search by the batcher.
+    
+    Args:
+        chain (RetrievalQA): Chain built by build_rag_chain
+        queries (List[str]): Questions to answer
+        
+    Returns:
+        List: For each query, in order, its response and timings as returned
+            by run_rag_query, or the exception it raised
+    """
+    async def gather():
+        return await asyncio.gather(
+            *(arun_rag_query(chain, query) for query in queries), return_exceptions=True
+        )
+    return chain.retriever.batcher.run(gather()).result()
@@ -1,18 +1,195 @@
 import dspy
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Callable, Optional, Tuple
 from langchain.schema import Document
 from langchain_community.vectorstores import FAISS
+from tenacity import AsyncRetrying, retry_if_exception_type, stop_after_attempt, wait_exponential
+import openai
+import diskcache
+import asyncio
+import hashlib
+import json
 import os
+import time
+import logging
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying: rate limits (429), server errors (5xx) and dropped connections
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+# Persistent cache of LLM outputs, shared across runs and processes
+_LLM_CACHE = diskcache.Cache("./.llm_cache")
+
+def _cache_key(model: str, signature, inputs: Dict[str, Any]) -> str:
+    """Build a content-addressed cache key for a signature call.
+    
+    Args:
+        model (str): Model the call is made against
+        signature: DSPy signature being predicted
+        inputs (Dict[str, Any]): Input field values for the call
+        
+    Returns:
+        str: Hex digest identifying (model, signature, inputs)
+    """
+    payload = json.dumps(
+        {
+            "model": model,
+            "signature": signature.__name__,
+            "instructions": signature.instructions,
+            "inputs": inputs
+        },
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _cached_predict(module, model: str, signature, **inputs) -> dspy.Prediction:
+    """Call a DSPy module, reusing a cached prediction for identical inputs.
+    
+    Args:
+        module: DSPy module to call on a cache miss
+        model (str): Model the module is configured with
+        signature: DSPy signature the module predicts
+        **inputs: Input field values passed to the module
+        
+    Returns:
+        dspy.Prediction: Cached or freshly generated prediction
+    """
+    key = _cache_key(model, signature, inputs)
+    cached = _LLM_CACHE.get(key)
+    if cached is not None:
+        return dspy.Prediction(**cached)
+    
+    result = module(**inputs)
+    _LLM_CACHE.set(key, dict(result.items()))
+    return result
+
+class InformationExtractor(dspy.Signature):
+    """Extract structured information from text."""
+    context = dspy.InputField(desc="Input text to process")
+    insights = dspy.OutputField(desc="Key insights and main points")
+    entities = dspy.OutputField(desc="Important entities and concepts")
+    summary = dspy.OutputField(desc="Concise summary")
+
+def _signature_to_messages(signature,
+                           inputs: Dict[str, Any],
+                           instructions: Optional[str] = None) -> List[Dict[str, str]]:
+    """Render a DSPy signature as chat messages requesting a JSON object.
+    
+    Args:
+        signature: DSPy signature describing the inputs and outputs
+        inputs (Dict[str, Any]): Values for the signature's input fields
+        instructions (Optional[str]): Extra instructions appended to the signature's own
+        
+    Returns:
+        List[Dict[str, str]]: System and user messages for a chat completion
+    """
+    outputs = {
+        name: field.json_schema_extra.get("desc", "").strip()
+        for name, field in signature.output_fields.items()
+    }
+    output_spec = "\n".join(f'- "{name}": {desc}' for name, desc in outputs.items())
+    
+    system_prompt = signature.instructions
+    if instructions:
+        system_prompt += f"\n\n{instructions}"
+    system_prompt += f"\n\nRespond with a JSON object containing these keys:\n{output_spec}"
+    
+    user_prompt = "\n\n".join(
+        f"{field.json_schema_extra.get('prefix', name + ':')} {inputs.get(name, '')}"
+        for name, field in signature.input_fields.items()
+    )
+    
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def run_batch_job(requests: Dict[str, List[Dict[str, str]]],
+                  model: str,
+                  poll_interval: float = 30.0,
+                  **body_kwargs) -> Dict[str, Dict[str, Any]]:
+    """Run chat completions through the OpenAI Batch API and wait for the results.
+    
+    The Batch API is billed at half the synchronous price and has its own rate
+    limits, which makes it a better fit for offline indexing jobs.
+    
+    Args:
+        requests (Dict[str, List[Dict[str, str]]]): Chat messages keyed by custom id
+        model (str): Name of the OpenAI model to use
+        poll_interval (float): Seconds to wait between status checks
+        **body_kwargs: Extra parameters for each chat completion body
+        
+    Returns:
+        Dict[str, Dict[str, Any]]: Parsed JSON responses keyed by custom id. Requests
+            that failed or returned invalid JSON are omitted.
+    """
+    client = openai.OpenAI()
+    
+    # 1. Serialize and upload requests
+    lines = [
+        json.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {
+                "model": model,
+                "messages": messages,
+                "response_format": {"type": "json_object"},
+                **body_kwargs
+            }
+        })
+        for custom_id, messages in requests.items()
+    ]
+    batch_file = client.files.create(
+        file=("batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    
+    # 2. Submit and wait for completion
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    logger.info(f"Submitted batch {batch.id} with {len(lines)} requests")
+    
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(poll_interval)
+        batch = client.batches.retrieve(batch.id)
+    
+    if batch.status != "completed":
+        raise RuntimeError(f"Batch {batch.id} finished with status {batch.status}")
+    
+    # 3. Download and parse results
+    results = {}
+    if batch.output_file_id:
+        output = client.files.content(batch.output_file_id).text
+        for line in output.splitlines():
+            record = json.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            try:
+                content = response["body"]["choices"][0]["message"]["content"]
+                results[record["custom_id"]] = json.loads(content)
+            except (KeyError, IndexError, json.JSONDecodeError):
+                continue
+    
+    return results
+
 class IEPPipeline:
     """Information Extraction and Processing Pipeline using DSPy."""
     
-    def __init__(self, model_name: str = "gpt-4o-mini"):
+    def __init__(self, model_name: str = "gpt-4o-mini", concurrency: int = 20, use_batch_api: bool = False):
         """Initialize the DSPy pipeline.
         
         Args:
             model_name (str): Name of the OpenAI model to use
+            concurrency (int): Maximum number of extraction requests in flight at once
+            use_batch_api (bool): Route extraction through the OpenAI Batch API
+                (half price, results within 24 hours) instead of live calls
         """
         # Initialize DSPy components
         api_key = os.getenv("OPENAI_API_KEY")
@@ -21,38 +198,157 @@ class IEPPipeline:
             
         self.lm = dspy.OpenAI(model=model_name)
         dspy.settings.configure(lm=self.lm)
-        
-        # Define extraction signature
-        class InformationExtractor(dspy.Signature):
-            """Extract structured information from text."""
-            context = dspy.InputField(desc="Input text to process")
-            insights = dspy.OutputField(desc="Key insights and main points")
-            entities = dspy.OutputField(desc="Important entities and concepts")
-            summary = dspy.OutputField(desc="Concise summary")
+        self.model_name = model_name
+        self.concurrency = concurrency
+        self.use_batch_api = use_batch_api
         
         self.extractor = dspy.Predict(InformationExtractor)
     
-    def process_documents(self, documents: List[Document]) -> List[Document]:
+    def forward(self, text: str) -> Dict[str, str]:
+        """Run the extractor over a single text.
+        
+        Args:
+            text (str): Text to extract information from
+            
+        Returns:
+            Dict[str, str]: Insights, entities and summary for the text
+        """
+        result = self._predict(text)
+        return {name: result.get(name, "") for name in InformationExtractor.output_fields}
+    
+    def _predict(self, text: str) -> dspy.Prediction:
+        """Run the extractor with this pipeline's LM.
+        
+        The LM set by dspy.settings.configure is only inherited by threads when
+        it was configured on the main thread, so it is pinned here for calls
+        from worker threads and Streamlit's script threads.
+        """
+        with dspy.context(lm=self.lm):
+            return _cached_predict(self.extractor, self.model_name, InformationExtractor, context=text)
+    
+    def process_documents(
+        self,
+        documents: List[Document],
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> List[Document]:
         """Process a list of documents through the DSPy pipeline.
         
+        Extraction calls are dispatched concurrently, so a batch costs roughly
+        the latency of its slowest document rather than the sum of all of them.
+        
         Args:
             documents (List[Document]): Original documents to process
+            on_progress (Optional[Callable[[int, int], None]]): Called with the number
+                of finished and total documents as each extraction completes. It
+                runs on the calling thread. Not called by the Batch API path.
             
         Returns:
             List[Document]: Enhanced documents with DSPy processing results
         """
+        if self.use_batch_api:
+            return self._process_documents_batch(documents)
+        return asyncio.run(self._aprocess_documents(documents, on_progress))
+    
+    def _process_documents_batch(self, documents: List[Document]) -> List[Document]:
+        """Run the extractor over all documents as a single Batch API job."""
+        keys = [
+            _cache_key(self.model_name, InformationExtractor, {"context": doc.page_content})
+            for doc in documents
+        ]
+        outputs = {f"doc-{idx}": _LLM_CACHE.get(key) for idx, key in enumerate(keys)}
+        
+        # Only submit documents without a cached result
+        requests = {
+            f"doc-{idx}": _signature_to_messages(InformationExtractor, {"context": doc.page_content})
+            for idx, doc in enumerate(documents)
+            if outputs[f"doc-{idx}"] is None
+        }
+        
+        if requests:
+            try:
+                fresh = run_batch_job(requests, model=self.model_name)
+            except Exception as e:
+                logger.warning(f"Error in DSPy batch processing: {e}")
+                fresh = {}
+            
+            for custom_id, output in fresh.items():
+                output = {name: output.get(name, "") for name in InformationExtractor.output_fields}
+                _LLM_CACHE.set(keys[int(custom_id.split("-")[1])], output)
+                outputs[custom_id] = output
+        
         enhanced_docs = []
+        for idx, doc in enumerate(documents):
+            output = outputs.get(f"doc-{idx}")
+            if output is None:
+                logger.debug(f"No batch result for document: {doc.metadata.get('source', 'unknown')}")
+                enhanced_docs.append(doc)
+                continue
+            
+            result = dspy.Prediction(**{
+                name: output.get(name, "") for name in InformationExtractor.output_fields
+            })
+            enhanced_docs.append(self._build_enhanced_document(doc, result))
         
-        for doc in documents:
+        failed = sum(output is None for output in outputs.values())
+        if failed:
+            logger.warning(f"DSPy processing failed for {failed} of {len(documents)} documents")
+        logger.info(f"Processed {len(documents) - failed} documents with DSPy ({failed} failed)")
+        return enhanced_docs
+    
+    async def _aprocess_documents(
+        self,
+        documents: List[Document],
+        on_progress: Optional[Callable[[int, int], None]] = None
+    ) -> List[Document]:
+        """Run the extractor over all documents concurrently, preserving order."""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        done = 0
+        
+        async def _extract_one(doc: Document):
+            nonlocal done
             try:
-                # Process with DSPy
-                result = self.extractor(context=doc.page_content)
-                
-                # Create enhanced content
-                enhanced_content = f"""
-Original Content:
-{doc.page_content}
-
+                async with semaphore:
+                    async for attempt in AsyncRetrying(
+                        retry=retry_if_exception_type(RETRYABLE_ERRORS),
+                        stop=stop_after_attempt(5),
+                        wait=wait_exponential(multiplier=1, max=30),
+                        reraise=True
+                    ):
+                        with attempt:
+                            # dspy modules are synchronous; run each call in a worker thread
+                            return await asyncio.to_thread(self._predict, doc.page_content)
+            finally:
+                done += 1
+                if on_progress:
+                    on_progress(done, len(documents))
+        
+        results = await asyncio.gather(
+            *[_extract_one(doc) for doc in documents],
+            return_exceptions=True
+        )
+        
+        enhanced_docs = []
+        failed = 0
+        for doc, result in zip(documents, results):
+            if isinstance(result, Exception):
+                logger.debug(f"Error in DSPy processing of {doc.metadata.get('source', 'unknown')}: {result}")
+                failed += 1
+                # Fall back to original document
+                enhanced_docs.append(doc)
+                continue
+            
+            enhanced_docs.append(self._build_enhanced_document(doc, result))
+        
+        if failed:
+            logger.warning(f"DSPy processing failed for {failed} of {len(documents)} documents")
+        logger.info(f"Processed {len(documents) - failed} documents with DSPy ({failed} failed)")
+        return enhanced_docs
+    
+    def _build_enhanced_document(self, doc: Document, result) -> Document:
+        """Combine an original document with its extraction result."""
+        # Create enhanced content
+        # The original text is indexed as its own document, so only the extraction is kept here
+        enhanced_content = f"""
 Key Insights:
 {result.insights}
 
@@ -62,64 +358,58 @@ Important Entities:
 Summary:
 {result.summary}
 """
-                
-                # Create enhanced document
-                enhanced_docs.append(Document(
-                    page_content=enhanced_content,
-                    metadata={
-                        **doc.metadata,
-                        "processed_with": "dspy",
-                        "enhancement_type": "full",
-                        "original_length": len(doc.page_content)
-                    }
-                ))
-                
-                print(f"Successfully processed document: {doc.metadata.get('source', 'unknown')}")
-                
-            except Exception as e:
-                print(f"Error in DSPy processing: {e}")
-                # Fall back to original document
-                enhanced_docs.append(doc)
         
-        return enhanced_docs
+        return Document(
+            page_content=enhanced_content,
+            metadata={
+                **doc.metadata,
+                "processed_with": "dspy",
+                "enhancement_type": "full",
+                "original_length": len(doc.page_content)
+            }
+        )
 
 def build_faiss_index_with_dspy(documents: List[Document], 
                                persist_directory: str,
-                               model_name: str = "gpt-4o-mini") -> Optional[FAISS]:
+                               model_name: str = "gpt-4o-mini",
+                               use_batch_api: bool = False,
+                               extra_files: Optional[Dict[str, str]] = None) -> Optional[FAISS]:
     """Build a FAISS index with DSPy-enhanced documents.
     
     Args:
         documents (List[Document]): Original documents to process
         persist_directory (str): Directory to save the FAISS index
         model_name (str): Name of the OpenAI model to use for DSPy
+        use_batch_api (bool): Process documents through the OpenAI Batch API
+        extra_files (Optional[Dict[str, str]]): File names and text saved
+            into persist_directory together with the index
         
     Returns:
         Optional[FAISS]: Enhanced FAISS vectorstore
     """
     try:
         # Initialize DSPy pipeline
-        pipeline = IEPPipeline(model_name=model_name)
+        pipeline = IEPPipeline(model_name=model_name, use_batch_api=use_batch_api)
         
-        # Process documents
-        enhanced_docs = pipeline.process_documents(documents)
+        # Process documents. Failed documents come back as the original
+        # object, which is indexed already, so only real extractions are added
+        enhanced_docs = [
+            enhanced for doc, enhanced in zip(documents, pipeline.process_documents(documents))
+            if enhanced is not doc
+        ]
         
         # Combine original and enhanced documents
         all_docs = documents + enhanced_docs
         
         # Build and return index
         from embeddings import build_faiss_index
-        return build_faiss_index(all_docs, persist_directory)
+        return build_faiss_index(all_docs, persist_directory, extra_files=extra_files)
         
     except Exception as e:
-        print(f"Error in DSPy-enhanced indexing: {e}")
+        logger.error(f"Error in DSPy-enhanced indexing: {e}")
         # Fall back to regular indexing
         from embeddings import build_faiss_index
-        return build_faiss_index(documents, persist_directory)
-
-class LessonPlanRM(dspy.Signature):
-    """Signature for the reasoning module."""
-    context = dspy.InputField()
-    reasoning = dspy.OutputField()
+        return build_faiss_index(documents, persist_directory, extra_files=extra_files)
 
 class LessonPlanSignature(dspy.Signature):
     """Signature for generating lesson plans with reasoning."""
@@ -135,7 +425,10 @@ class LessonPlanSignature(dspy.Signature):
     timeframe = dspy.InputField(desc="Daily or weekly planning timeframe")
     days = dspy.InputField(desc="Days of the week for instruction")
     
-    # Output fields with detailed structure requirements
+    # Output fields with detailed structure requirements. Reasoning comes first so the
+    # plan fields are generated after, and conditioned on, the analysis.
+    reasoning = dspy.OutputField(desc="Step-by-step analysis of the IEP requirements behind the plan")
+    
     schedule = dspy.OutputField(desc="""
         Detailed daily schedule including:
         - Warm-up activities (5-10 minutes)
@@ -195,10 +488,125 @@ class LessonPlanSignature(dspy.Signature):
         Minimum 5 specific strategies
     """)
 
+# Static instructions shared by every lesson plan request. Keep this (and the
+# example below) free of per-request values so the prompt prefix is byte-identical
+# across calls and can be served from the provider's prompt cache.
+LESSON_PLAN_INSTRUCTIONS = """
+As an experienced special education teacher, create a detailed and comprehensive lesson plan following these steps:
+
+1. Analyze the IEP requirements and student needs:
+- Review all accommodations and modifications needed
+- Identify specific learning style preferences
+- Note particular challenges and strengths
+- Consider past performance and progress
+
+2. Design comprehensive grade-level learning objectives:
+- Align with curriculum standards
+- Break down complex concepts into manageable parts
+- Set both short-term and long-term goals
+- Include measurable outcomes
+
+3. Create detailed accommodations and modifications:
+- Incorporate all IEP requirements
+- Design multiple forms of visual and hands-on activities
+- Plan differentiated instruction for various skill levels
+- Include technology and multi-sensory approaches
+
+4. Develop a structured yet flexible lesson plan:
+- Create detailed timeline with buffer time
+- Include varied activities for different learning styles
+- Plan transition strategies
+- Incorporate regular check-ins and assessments
+
+5. Design assessment and progress monitoring:
+- Include multiple forms of assessment
+- Plan for ongoing progress monitoring
+- Create success criteria
+- Design feedback mechanisms
+
+Ensure all components are detailed, specific, and aligned with student needs.
+Minimum length for each section: 200 words
+"""
+
+# Detailed example for better zero-shot learning
+LESSON_PLAN_EXAMPLE = {
+    "iep_content": "Student requires extended time, visual aids, and hands-on learning",
+    "subject": "Mathematics",
+    "grade_level": "3rd Grade",
+    "duration": "45 minutes",
+    "specific_goals": "Understanding Pythagoras theorem through practical applications",
+    "materials": "Cardboard triangles, measuring tape, grid paper",
+    "additional_accommodations": "Connect to real-world examples, provide visual supports",
+    "timeframe": "weekly",
+    "days": "Monday through Friday",
+    "schedule": """
+        Daily Schedule Pattern:
+        1. Warm-up (5 min): Review previous concepts using visual aids
+        2. Introduction (10 min): Present new concept with real-world examples
+        3. Guided Practice (15 min): Hands-on activities with manipulatives
+        4. Independent Work (10 min): Practice with support as needed
+        5. Closure (5 min): Quick assessment and preview next day
+    """,
+    "lesson_plan": """
+        Week-long Progression:
+        Monday: Introduction to right triangles using real objects
+        Tuesday: Exploring square numbers with grid paper
+        Wednesday: Discovering Pythagoras pattern with manipulatives
+        Thursday: Applying theorem to real-world problems
+        Friday: Review and creative applications
+
+        Teaching Methodology:
+        - Use visual aids consistently
+        - Incorporate hands-on activities
+        - Connect to real-world examples
+        - Provide frequent checks for understanding
+        - Allow extended time as needed
+    """,
+    "learning_objectives": [
+        "Identify right triangles in real-world objects",
+        "Calculate missing sides using Pythagoras theorem",
+        "Apply theorem to solve practical problems",
+        "Demonstrate understanding through multiple methods"
+    ],
+    "assessment_criteria": [
+        "Accurate identification of right triangles",
+        "Correct calculation of missing sides",
+        "Proper use of theorem in applications",
+        "Clear explanation of process"
+    ],
+    "modifications": [
+        "Extended time for calculations",
+        "Use of calculator when needed",
+        "Visual step-by-step guides",
+        "Reduced problem set with increased depth"
+    ],
+    "instructional_strategies": [
+        "Multi-sensory approach to learning",
+        "Regular comprehension checks",
+        "Peer learning opportunities",
+        "Visual and hands-on demonstrations"
+    ]
+}
+
+# Few-shot demos bootstrapped with compile_lesson_plan_program, loaded when present
+LESSON_PLAN_PROGRAM_PATH = "lesson_plan.json"
+
+LESSON_PLAN_SYSTEM_PROMPT = (
+    f"{LESSON_PLAN_INSTRUCTIONS}\n"
+    f"Example lesson plan:\n{json.dumps(LESSON_PLAN_EXAMPLE, indent=2)}"
+)
+
 class LessonPlanPipeline:
     """Pipeline for generating adaptive lesson plans from IEPs."""
     
-    def __init__(self, model_name: str = "gpt-4"):
+    def __init__(self, model_name: str = "gpt-4o-mini", program_path: Optional[str] = LESSON_PLAN_PROGRAM_PATH):
+        """Initialize the pipeline.
+        
+        Args:
+            model_name (str): OpenAI model used for generation
+            program_path (Optional[str]): Compiled program whose demos are loaded if the
+                file exists; None to run the generator zero-shot
+        """
         self.lm = dspy.OpenAI(
             model=model_name,
             max_tokens=2000  # Increase token limit
@@ -206,108 +614,26 @@ class LessonPlanPipeline:
         
         dspy.settings.configure(lm=self.lm)
         
-        self.reasoning_module = dspy.ChainOfThought(LessonPlanRM)
-        self.generator = dspy.ChainOfThought(LessonPlanSignature)
-        
-        # Enhanced prompt template
-        self.prompt_template = """
-        As an experienced special education teacher, create a detailed and comprehensive lesson plan following these steps:
-        
-        1. Analyze the IEP requirements and student needs:
-        - Review all accommodations and modifications needed
-        - Identify specific learning style preferences
-        - Note particular challenges and strengths
-        - Consider past performance and progress
-        
-        2. Design comprehensive grade-level learning objectives:
-        - Align with curriculum standards
-        - Break down complex concepts into manageable parts
-        - Set both short-term and long-term goals
-        - Include measurable outcomes
-        
-        3. Create detailed accommodations and modifications:
-        - Incorporate all IEP requirements
-        - Design multiple forms of visual and hands-on activities
-        - Plan differentiated instruction for various skill levels
-        - Include technology and multi-sensory approaches
-        
-        4. Develop a structured yet flexible lesson plan:
-        - Create detailed timeline with buffer time
-        - Include varied activities for different learning styles
-        - Plan transition strategies
-        - Incorporate regular check-ins and assessments
-        
-        5. Design assessment and progress monitoring:
-        - Include multiple forms of assessment
-        - Plan for ongoing progress monitoring
-        - Create success criteria
-        - Design feedback mechanisms
-        
-        Ensure all components are detailed, specific, and aligned with student needs.
-        Minimum length for each section: 200 words
-        """
+        # Static instructions go first so every request shares the same prompt prefix
+        self.signature = LessonPlanSignature.with_instructions(
+            f"{LESSON_PLAN_SYSTEM_PROMPT}\n\n{LessonPlanSignature.instructions}"
+        )
+        self.prompt_template = LESSON_PLAN_INSTRUCTIONS
+        self.example = LESSON_PLAN_EXAMPLE
         
-        print("Successfully initialized LessonPlanPipeline")
-        
-        # Add detailed example for better zero-shot learning
-        self.example = {
-            "iep_content": "Student requires extended time, visual aids, and hands-on learning",
-            "subject": "Mathematics",
-            "grade_level": "3rd Grade",
-            "duration": "45 minutes",
-            "specific_goals": "Understanding Pythagoras theorem through practical applications",
-            "materials": "Cardboard triangles, measuring tape, grid paper",
-            "additional_accommodations": "Connect to real-world examples, provide visual supports",
-            "timeframe": "weekly",
-            "days": "Monday through Friday",
-            "schedule": """
-                Daily Schedule Pattern:
-                1. Warm-up (5 min): Review previous concepts using visual aids
-                2. Introduction (10 min): Present new concept with real-world examples
-                3. Guided Practice (15 min): Hands-on activities with manipulatives
-                4. Independent Work (10 min): Practice with support as needed
-                5. Closure (5 min): Quick assessment and preview next day
-            """,
-            "lesson_plan": """
-                Week-long Progression:
-                Monday: Introduction to right triangles using real objects
-                Tuesday: Exploring square numbers with grid paper
-                Wednesday: Discovering Pythagoras pattern with manipulatives
-                Thursday: Applying theorem to real-world problems
-                Friday: Review and creative applications
-                
-                Teaching Methodology:
-                - Use visual aids consistently
-                - Incorporate hands-on activities
-                - Connect to real-world examples
-                - Provide frequent checks for understanding
-                - Allow extended time as needed
-            """,
-            "learning_objectives": [
-                "Identify right triangles in real-world objects",
-                "Calculate missing sides using Pythagoras theorem",
-                "Apply theorem to solve practical problems",
-                "Demonstrate understanding through multiple methods"
-            ],
-            "assessment_criteria": [
-                "Accurate identification of right triangles",
-                "Correct calculation of missing sides",
-                "Proper use of theorem in applications",
-                "Clear explanation of process"
-            ],
-            "modifications": [
-                "Extended time for calculations",
-                "Use of calculator when needed",
-                "Visual step-by-step guides",
-                "Reduced problem set with increased depth"
-            ],
-            "instructional_strategies": [
-                "Multi-sensory approach to learning",
-                "Regular comprehension checks",
-                "Peer learning opportunities",
-                "Visual and hands-on demonstrations"
-            ]
-        }
+        # A single call produces both the reasoning and the plan. Predict rather than
+        # ChainOfThought, which would add a second, redundant rationale field.
+        self.generator = dspy.Predict(self.signature)
+        
+        # Cached generations are only valid for the demos they were produced with
+        self.cache_model = model_name
+        if program_path and os.path.exists(program_path):
+            self.generator.load(program_path)
+            with open(program_path, "rb") as f:
+                self.cache_model = f"{model_name}@{hashlib.sha256(f.read()).hexdigest()[:12]}"
+            logger.info(f"Loaded compiled lesson plan program from {program_path}")
+        
+        logger.debug("Successfully initialized LessonPlanPipeline")
     
     def _format_list_to_string(self, items: List[str]) -> str:
         """Convert a list of items to a numbered string."""
@@ -315,70 +641,122 @@ class LessonPlanPipeline:
             return ""
         return "\n".join(f"{i+1}. {item}" for i, item in enumerate(items))
     
+    def _prepare_inputs(self, data: Dict[str, Any], timeframe: str) -> Dict[str, str]:
+        """Format form and IEP data as string inputs for the lesson plan signature."""
+        # Format list inputs to strings
+        specific_goals_str = "\n".join(data["specific_goals"]) if isinstance(data["specific_goals"], list) else str(data["specific_goals"])
+        materials_str = "\n".join(data.get("materials", [])) if isinstance(data.get("materials"), list) else str(data.get("materials", ""))
+        accommodations_str = "\n".join(data.get("additional_accommodations", [])) if isinstance(data.get("additional_accommodations"), list) else str(data.get("additional_accommodations", ""))
+        days_str = ", ".join(data.get("days", [])) if isinstance(data.get("days"), list) else str(data.get("days", ""))
+        
+        return {
+            "iep_content": data["iep_content"],
+            "subject": data["subject"],
+            "grade_level": data["grade_level"],
+            "duration": data["duration"],
+            "specific_goals": specific_goals_str,
+            "materials": materials_str,
+            "additional_accommodations": accommodations_str,
+            "timeframe": timeframe,
+            "days": days_str
+        }
+    
+    def _assemble_plan(self, data: Dict[str, Any], timeframe: str, result) -> Dict[str, Any]:
+        """Combine generator output with request metadata into a plan dictionary."""
+        return {
+            "timestamp": datetime.now().isoformat(),
+            "timeframe": timeframe,
+            "subject": data["subject"],
+            "grade_level": data["grade_level"],
+            "duration": data["duration"],
+            "reasoning": result.reasoning,
+            "schedule": result.schedule,
+            "lesson_plan": result.lesson_plan,
+            "learning_objectives": self._process_field(result, 'learning_objectives'),
+            "assessment_criteria": self._process_field(result, 'assessment_criteria'),
+            "modifications": self._process_field(result, 'modifications'),
+            "instructional_strategies": self._process_field(result, 'instructional_strategies'),
+            "source_iep": data["source_iep"],
+            "quality_score": self.evaluate_lesson_plan(result)
+        }
+    
     def generate_lesson_plan(self, data: Dict[str, Any], timeframe: str) -> Dict[str, Any]:
         """Generate a detailed daily or weekly lesson plan."""
         try:
-            print("Starting lesson plan generation...")
-            
-            # Format list inputs to strings
-            specific_goals_str = "\n".join(data["specific_goals"]) if isinstance(data["specific_goals"], list) else str(data["specific_goals"])
-            materials_str = "\n".join(data.get("materials", [])) if isinstance(data.get("materials"), list) else str(data.get("materials", ""))
-            accommodations_str = "\n".join(data.get("additional_accommodations", [])) if isinstance(data.get("additional_accommodations"), list) else str(data.get("additional_accommodations", ""))
-            days_str = ", ".join(data.get("days", [])) if isinstance(data.get("days"), list) else str(data.get("days", ""))
-            
-            # First, generate reasoning about the plan
-            context = f"""
-            IEP Content: {data['iep_content']}
-            Subject: {data['subject']}
-            Grade Level: {data['grade_level']}
-            Duration: {data['duration']}
-            Goals: {specific_goals_str}
+            logger.debug("Starting lesson plan generation...")
             
-            Instructions: {self.prompt_template}
-            """
+            inputs = self._prepare_inputs(data, timeframe)
             
-            reasoning = self.reasoning_module(context=context).reasoning
-            
-            # Then generate the actual plan using the reasoning
-            result = self.generator(
-                iep_content=data["iep_content"],
-                subject=data["subject"],
-                grade_level=data["grade_level"],
-                duration=data["duration"],
-                specific_goals=specific_goals_str,
-                materials=materials_str,
-                additional_accommodations=accommodations_str,
-                timeframe=timeframe,
-                days=days_str
-            )
+            # Run against this pipeline's model even if another pipeline reconfigured dspy
+            with dspy.context(lm=self.lm):
+                result = _cached_predict(self.generator, self.cache_model, self.signature, **inputs)
             
             # Process and format the result
-            plan_data = {
-                "timestamp": datetime.now().isoformat(),
-                "timeframe": timeframe,
-                "subject": data["subject"],
-                "grade_level": data["grade_level"],
-                "duration": data["duration"],
-                "reasoning": reasoning,
-                "schedule": result.schedule,
-                "lesson_plan": result.lesson_plan,
-                "learning_objectives": self._process_field(result, 'learning_objectives'),
-                "assessment_criteria": self._process_field(result, 'assessment_criteria'),
-                "modifications": self._process_field(result, 'modifications'),
-                "instructional_strategies": self._process_field(result, 'instructional_strategies'),
-                "source_iep": data["source_iep"],
-                "quality_score": self.evaluate_lesson_plan(result)
-            }
-            
-            return plan_data
+            return self._assemble_plan(data, timeframe, result)
             
         except Exception as e:
-            print(f"Detailed error in generate_lesson_plan: {str(e)}")
-            print(f"Error type: {type(e)}")
-            import traceback
-            print(f"Traceback: {traceback.format_exc()}")
+            logger.exception(f"Error in generate_lesson_plan: {e}")
             return self._generate_basic_plan(data, timeframe)
     
+    def generate_lesson_plans_batch(self, requests: List[Tuple[Dict[str, Any], str]]) -> List[Optional[Dict[str, Any]]]:
+        """Generate many lesson plans as a single OpenAI Batch API job.
+        
+        Args:
+            requests (List[Tuple[Dict[str, Any], str]]): (data, timeframe) pairs, as
+                accepted by generate_lesson_plan
+                
+        Returns:
+            List[Optional[Dict[str, Any]]]: Plans in request order; requests without a
+                batch result fall back to a basic plan
+        """
+        model = self.lm.kwargs["model"]
+        all_inputs = [self._prepare_inputs(data, timeframe) for data, timeframe in requests]
+        # Batch requests carry no demos, so they share cache entries with zero-shot live calls
+        keys = [_cache_key(model, self.signature, inputs) for inputs in all_inputs]
+        outputs = {f"plan-{idx}": _LLM_CACHE.get(key) for idx, key in enumerate(keys)}
+        
+        # Only submit requests without a cached result
+        messages = {
+            f"plan-{idx}": _signature_to_messages(self.signature, inputs)
+            for idx, inputs in enumerate(all_inputs)
+            if outputs[f"plan-{idx}"] is None
+        }
+        
+        if messages:
+            try:
+                fresh = run_batch_job(messages, model=model, max_tokens=self.lm.kwargs["max_tokens"])
+            except Exception as e:
+                logger.warning(f"Error in lesson plan batch generation: {str(e)}")
+                fresh = {}
+            
+            for custom_id, output in fresh.items():
+                # Partial completions would be served from the cache forever, so
+                # they fall back to a basic plan and are retried next time
+                if not self._is_complete_output(output):
+                    logger.warning(f"Incomplete lesson plan in batch result {custom_id}")
+                    continue
+                _LLM_CACHE.set(keys[int(custom_id.split("-")[1])], output)
+                outputs[custom_id] = output
+        
+        plans = []
+        for idx, (data, timeframe) in enumerate(requests):
+            output = outputs.get(f"plan-{idx}")
+            if output is None:
+                plans.append(self._generate_basic_plan(data, timeframe))
+                continue
+            
+            result = dspy.Prediction(**{
+                name: output.get(name, "") for name in LessonPlanSignature.output_fields
+            })
+            plans.append(self._assemble_plan(data, timeframe, result))
+        
+        return plans
+    
+    @staticmethod
+    def _is_complete_output(output: Any) -> bool:
+        """Whether a batch output is a dict with every generated field filled in."""
+        return isinstance(output, dict) and all(output.get(name) for name in LessonPlanSignature.output_fields)
+    
     def _generate_basic_plan(self, data: Dict[str, Any], timeframe: str) -> Dict[str, Any]:
         """Generate a basic lesson plan when the main generation fails."""
         try:
@@ -400,7 +778,7 @@ class LessonPlanPipeline:
             }
             return basic_plan
         except Exception as e:
-            print(f"Error in basic plan generation: {str(e)}")
+            logger.error(f"Error in basic plan generation: {e}")
             return None
     
     def _create_basic_schedule(self, data: Dict[str, Any], timeframe: str) -> str:
@@ -419,7 +797,8 @@ class LessonPlanPipeline:
             return value
         return []
     
-    def evaluate_lesson_plan(self, plan: Dict[str, Any]) -> float:
+    @staticmethod
+    def evaluate_lesson_plan(plan: Dict[str, Any]) -> float:
         """Evaluate the quality of a generated lesson plan."""
         try:
             score = 0.0
@@ -440,46 +819,128 @@ class LessonPlanPipeline:
             return score
             
         except Exception as e:
-            print(f"Error in evaluate_lesson_plan: {str(e)}")
+            logger.error(f"Error in evaluate_lesson_plan: {e}")
             return 0.0
 
+def compile_lesson_plan_program(trainset: List[Tuple[Dict[str, Any], str]],
+                                output_path: str = LESSON_PLAN_PROGRAM_PATH,
+                                student_model: str = "gpt-4o-mini",
+                                teacher_model: str = "gpt-4",
+                                metric_threshold: float = 0.7) -> dspy.Module:
+    """Bootstrap few-shot demos from a large teacher model for a small student model.
+    
+    The teacher generates plans for the training requests; those scoring at least
+    `metric_threshold` under evaluate_lesson_plan become demos for the student's
+    generator. LessonPlanPipeline loads the saved program on initialization.
+    
+    Args:
+        trainset (List[Tuple[Dict[str, Any], str]]): (data, timeframe) pairs, as
+            accepted by generate_lesson_plan
+        output_path (str): Where to save the compiled program
+        student_model (str): Model that serves lesson plans at runtime
+        teacher_model (str): Model used to generate the demos
+        metric_threshold (float): Minimum quality score for a demo to be kept
+        
+    Returns:
+        dspy.Module: The compiled generator
+    """
+    student = LessonPlanPipeline(model_name=student_model, program_path=None)
+    examples = [
+        dspy.Example(**student._prepare_inputs(data, timeframe)).with_inputs(*LessonPlanSignature.input_fields)
+        for data, timeframe in trainset
+    ]
+    
+    optimizer = dspy.BootstrapFewShot(
+        metric=lambda example, prediction, trace=None: LessonPlanPipeline.evaluate_lesson_plan(prediction),
+        metric_threshold=metric_threshold,
+        teacher_settings={"lm": dspy.OpenAI(model=teacher_model, max_tokens=student.lm.kwargs["max_tokens"])}
+    )
+    compiled = optimizer.compile(student.generator, trainset=examples)
+    
+    compiled.save(output_path)
+    logger.info(f"Saved compiled lesson plan program to {output_path}")
+    return compiled
+
+def _iep_document_to_plan_data(doc: Document, iep_doc: Document) -> Dict[str, Any]:
+    """Build lesson plan request data from a processed IEP document."""
+    iep_content = doc.page_content
+    if iep_doc is not doc:
+        # Enhanced documents hold just the extraction, not the original text
+        iep_content = f"{doc.page_content}\n\n{iep_doc.page_content}"
+    
+    return {
+        "iep_content": iep_content,
+        "subject": doc.metadata.get("subject", "General"),
+        "grade_level": doc.metadata.get("grade_level", "Not specified"),
+        "duration": doc.metadata.get("duration", "45 minutes"),
+        "specific_goals": doc.metadata.get("specific_goals", "Goals identified in the IEP"),
+        "source_iep": doc.metadata.get("source")
+    }
+
+def _lesson_plan_document(pipeline: LessonPlanPipeline, doc: Document, timeframe: str, lesson_plan: Dict[str, Any]) -> Document:
+    """Evaluate a generated lesson plan and wrap it in a document."""
+    # Evaluate the plan
+    quality_score = pipeline.evaluate_lesson_plan(lesson_plan)
+    lesson_plan["quality_score"] = quality_score
+    
+    return Document(
+        page_content=str(lesson_plan),
+        metadata={
+            **doc.metadata,
+            "type": "lesson_plan",
+            "timeframe": timeframe,
+            "quality_score": quality_score,
+            "source_iep": doc.metadata.get("source")
+        }
+    )
+
 def process_iep_to_lesson_plans(documents: List[Document], 
-                              timeframes: List[str] = ["initial", "mid-year", "annual"]) -> List[Document]:
-    """Process IEPs and generate lesson plans for multiple timeframes."""
+                              timeframes: List[str] = ["initial", "mid-year", "annual"],
+                              use_batch_api: bool = False) -> List[Document]:
+    """Process IEPs and generate lesson plans for multiple timeframes.
+    
+    Args:
+        documents (List[Document]): IEP documents to process
+        timeframes (List[str]): Timeframes to generate a lesson plan for
+        use_batch_api (bool): Run both stages as OpenAI Batch API jobs
+        
+    Returns:
+        List[Document]: One lesson plan document per IEP and timeframe
+    """
     pipeline = LessonPlanPipeline()
     enhanced_docs = []
     
-    for doc in documents:
-        try:
-            # First, generate IEP data
-            iep_pipeline = IEPPipeline()
-            iep_result = iep_pipeline.process_documents([doc])[0]
-            
-            # Then generate lesson plans for each timeframe
-            for timeframe in timeframes:
-                lesson_plan = pipeline.generate_lesson_plan(
-                    iep_data={"content": iep_result.page_content, "source": doc.metadata.get("source")},
-                    timeframe=timeframe
-                )
-                
-                if lesson_plan:
-                    # Evaluate the plan
-                    quality_score = pipeline.evaluate_lesson_plan(lesson_plan)
-                    lesson_plan["quality_score"] = quality_score
-                    
-                    # Create a new document
-                    enhanced_docs.append(Document(
-                        page_content=str(lesson_plan),
-                        metadata={
-                            **doc.metadata,
-                            "type": "lesson_plan",
-                            "timeframe": timeframe,
-                            "quality_score": quality_score,
-                            "source_iep": doc.metadata.get("source")
-                        }
-                    ))
-                    
-        except Exception as e:
-            print(f"Error processing document for lesson plans: {e}")
+    if use_batch_api:
+        iep_docs = IEPPipeline(use_batch_api=True).process_documents(documents)
+        pairs = [(doc, iep_doc, timeframe) for doc, iep_doc in zip(documents, iep_docs) for timeframe in timeframes]
+        lesson_plans = pipeline.generate_lesson_plans_batch(
+            [(_iep_document_to_plan_data(doc, iep_doc), timeframe) for doc, iep_doc, timeframe in pairs]
+        )
+        
+        for (doc, _, timeframe), lesson_plan in zip(pairs, lesson_plans):
+            if lesson_plan:
+                enhanced_docs.append(_lesson_plan_document(pipeline, doc, timeframe, lesson_plan))
+        
+        return enhanced_docs
+    
+    # First, generate IEP data for every document concurrently
+    try:
+        iep_docs = IEPPipeline().process_documents(documents)
+    except Exception as e:
+        logger.error(f"Error processing documents for lesson plans: {e}")
+        return enhanced_docs
+    
+    pairs = [(doc, iep_doc, timeframe) for doc, iep_doc in zip(documents, iep_docs) for timeframe in timeframes]
+    
+    # Then generate every (IEP, timeframe) lesson plan in parallel
+    parallel = dspy.Parallel(num_threads=16, disable_progress_bar=True)
+    lesson_plans = parallel([
+        (pipeline.generate_lesson_plan, (_iep_document_to_plan_data(doc, iep_doc), timeframe))
+        for doc, iep_doc, timeframe in pairs
+    ])
+    
+    for (doc, _, timeframe), lesson_plan in zip(pairs, lesson_plans):
+        if lesson_plan:
+            enhanced_docs.append(_lesson_plan_document(pipeline, doc, timeframe, lesson_plan))
             
     return enhanced_docs
@@ -1,96 +1,751 @@
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import OpenAIEmbeddings
-from typing import List, Optional
+from langchain_core.embeddings import Embeddings
+from typing import Callable, Dict, List, Optional
 from langchain.schema import Document
+from collections import OrderedDict
+from openai import OpenAI, AsyncOpenAI
+from diskcache import Cache
+import httpx
+import numpy as np
+import faiss
+import asyncio
+import functools
+import threading
+import hashlib
+import math
+import pickle
+import shutil
+import uuid
 import os
 import logging
 
 logger = logging.getLogger(__name__)
 
-def build_faiss_index(documents: List[Document], persist_directory: str, chunk_size: int = 1000) -> Optional[FAISS]:
-    """Build an optimized FAISS index from documents.
+# faiss-cpu wheels load the widest SIMD build the CPU supports (FAISS_OPT_LEVEL
+# overrides the choice); a generic build runs the distance kernels scalar
+if not any(opt in faiss.get_compile_options() for opt in ("AVX2", "AVX512", "NEON", "SVE")):
+    logger.warning("FAISS was built without SIMD support; indexing and search will be slow")
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# text-embedding-3 models are trained to be truncatable: 512 dims keeps most of
+# the retrieval quality at a third of the storage and search cost of 1536
+EMBEDDING_DIMENSIONS = 512
+# Inputs per /v1/embeddings request. The API accepts up to 2048, but requests are
+# also capped at 300k tokens, which 1024 default-sized chunks stay well under.
+# Both can be tuned with environment variables of the same name.
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "1024"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "10"))
+# Connection pool shared by query-time embedding and chat requests, kept alive across calls
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+# Chunk embeddings from previous runs, keyed by model and chunk text
+_EMBED_CACHE = Cache(os.path.join("models", "emb_cache"))
+
+# Training thresholds below which IVF-PQ is not worth it: faiss wants ~39 points
+# per centroid, both coarse and in each 256-centroid 8-bit PQ codebook, and the
+# OPQ rotation needs at least as many points as dimensions
+MIN_POINTS_PER_CENTROID = 39
+MIN_PQ_TRAINING_POINTS = 256 * MIN_POINTS_PER_CENTROID
+# Training points faiss uses per coarse centroid or codebook entry; it
+# subsamples beyond this anyway, so IVF-PQ trains on a sample this large
+MAX_POINTS_PER_CENTROID = 256
+# Vector encodings of the IVF index types: uncompressed, or scalar-quantized
+_IVF_ENCODINGS = {"ivfflat": "Flat", "ivfsq8": "SQ8", "ivfsqfp16": "SQfp16"}
+# "auto" picks HNSW below this many vectors and IVF-PQ above it
+HNSW_MAX_VECTORS = 50_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+
+def _usable_cpus() -> int:
+    """CPUs this process may run on, honouring affinity masks such as container cpusets."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def _configure_faiss_threads() -> None:
+    """Let FAISS use every usable core for training, adding and batched search."""
+    faiss.omp_set_num_threads(_usable_cpus())
+
+def _embedding_key(model: str, text: str) -> str:
+    """Cache key for one text's embedding; the model id salts out stale vectors."""
+    model_id = f"{model}@{EMBEDDING_DIMENSIONS}"
+    return hashlib.sha256((model_id + "\0" + text).encode()).hexdigest()
+
+def _cached_embed(
+    texts: List[str],
+    model: str,
+    embed_missed: Callable[[List[str]], np.ndarray]
+) -> np.ndarray:
+    """Embed texts through the disk cache, calling `embed_missed` once for the misses."""
+    keys = [_embedding_key(model, text) for text in texts]
+    xb = np.empty((len(texts), EMBEDDING_DIMENSIONS), dtype=np.float32)
+    missed = []
+    for i, key in enumerate(keys):
+        vector = _EMBED_CACHE.get(key)
+        if vector is None:
+            missed.append(i)
+        else:
+            xb[i] = vector
+    
+    if missed:
+        xb[missed] = embed_missed([texts[i] for i in missed])
+        with _EMBED_CACHE.transact():
+            for i in missed:
+                _EMBED_CACHE.set(keys[i], xb[i])
+    logger.debug(f"Embedding cache: {len(texts) - len(missed)} hits, {len(missed)} misses")
+    
+    return xb
+
+class CachedEmbeddings(Embeddings):
+    """Embeddings that reuse cached vectors for previously seen texts.
+    
+    Document embeddings go through the on-disk embedding cache. Query
+    embeddings are kept in an in-process LRU for repeated questions, and
+    never written to disk.
+    """
+    
+    def __init__(self, embeddings: OpenAIEmbeddings, query_cache_size: int = 4096):
+        self.embeddings = embeddings
+        self.query_cache_size = query_cache_size
+        self._queries: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._queries_lock = threading.Lock()
+    
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embed_missed = lambda missed: np.asarray(self.embeddings.embed_documents(missed), dtype=np.float32)
+        return _cached_embed(texts, self.embeddings.model, embed_missed).tolist()
+    
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed a batch of queries in one request, skipping those seen recently."""
+        with self._queries_lock:
+            vectors = {text: self._queries[text] for text in texts if text in self._queries}
+            for text in vectors:
+                self._queries.move_to_end(text)
+        
+        missed = list(dict.fromkeys(text for text in texts if text not in vectors))
+        if missed:
+            vectors.update(zip(missed, self.embeddings.embed_documents(missed)))
+            with self._queries_lock:
+                for text in missed:
+                    self._queries[text] = vectors[text]
+                while len(self._queries) > self.query_cache_size:
+                    self._queries.popitem(last=False)
+        
+        return [list(vectors[text]) for text in texts]
+    
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_queries([text])[0]
+
+@functools.lru_cache(maxsize=1)
+def get_http_client() -> httpx.Client:
+    """Return the process-wide HTTP client for synchronous OpenAI requests.
+    
+    Connections stay open between calls, so embedding and chat requests skip
+    the TCP and TLS handshakes after the first one.
+    """
+    return httpx.Client(limits=HTTP_LIMITS)
+
+@functools.lru_cache(maxsize=1)
+def _get_embeddings(api_key: str) -> CachedEmbeddings:
+    """Return the process-wide embeddings, backed by one pooled HTTP client.
     
     Args:
-        documents (List[Document]): List of LangChain documents to index
-        persist_directory (str): Directory to save the FAISS index
-        chunk_size (int, optional): Size of text chunks. Defaults to 1000.
+        api_key (str): OpenAI API key
         
     Returns:
-        Optional[FAISS]: Initialized and populated FAISS vectorstore
+        CachedEmbeddings: Query embeddings shared by every index built or loaded
+    """
+    client = OpenAI(api_key=api_key, http_client=get_http_client())
+    return CachedEmbeddings(OpenAIEmbeddings(
+        model=EMBEDDING_MODEL,
+        model_kwargs={"dimensions": EMBEDDING_DIMENSIONS},
+        openai_api_key=api_key,
+        client=client.embeddings,
+        # Documents embedded through the vectorstore batch like _embed_texts
+        chunk_size=EMBED_BATCH_SIZE
+    ))
+
+async def _aembed_texts(texts: List[str], model: str, batch_size: int, concurrency: int) -> np.ndarray:
+    """Embed texts in large batches, issuing up to `concurrency` requests at once."""
+    # The async pool is bound to this event loop, so it lives for one embedding run
+    client = AsyncOpenAI(http_client=httpx.AsyncClient(
+        limits=httpx.Limits(max_keepalive_connections=concurrency, max_connections=concurrency)
+    ))
+    semaphore = asyncio.Semaphore(concurrency)
+    # Each response is written straight into its slice of one contiguous matrix
+    xb = np.empty((len(texts), EMBEDDING_DIMENSIONS), dtype=np.float32)
+    
+    async def embed_batch(start: int) -> None:
+        async with semaphore:
+            response = await client.embeddings.create(
+                model=model,
+                input=texts[start:start + batch_size],
+                dimensions=EMBEDDING_DIMENSIONS
+            )
+            for item in response.data:
+                xb[start + item.index] = item.embedding
+    
+    try:
+        await asyncio.gather(*[embed_batch(start) for start in range(0, len(texts), batch_size)])
+    finally:
+        await client.close()
+    
+    return xb
+
+def _embed_texts(
+    texts: List[str],
+    model: str = EMBEDDING_MODEL,
+    batch_size: int = EMBED_BATCH_SIZE,
+    concurrency: int = EMBED_CONCURRENCY
+) -> np.ndarray:
+    """Embed texts into an (N, d) float32 matrix, preserving input order.
+    
+    Texts embedded on a previous run are served from the embedding cache;
+    only the rest are sent to the API.
+    
+    Args:
+        texts (List[str]): Texts to embed
+        model (str): OpenAI embedding model name
+        batch_size (int): Number of inputs per embeddings request
+        concurrency (int): Maximum number of requests in flight
+        
+    Returns:
+        np.ndarray: Embedding matrix with one row per text
+    """
+    embed_missed = lambda missed: asyncio.run(_aembed_texts(missed, model, batch_size, concurrency))
+    return _cached_embed(texts, model, embed_missed)
+
+def _binarize(x: np.ndarray) -> np.ndarray:
+    """Sign-threshold float vectors and pack them into 1-bit-per-dimension codes."""
+    return np.packbits(x > 0, axis=1)
+
+class BinaryRerankIndex:
+    """Binary FAISS index with exact re-ranking against the float vectors.
+    
+    Candidates are found by Hamming distance over 1-bit codes (d/8 bytes per
+    vector), then re-scored by inner product against the original float32
+    vectors, which are memory-mapped from disk once saved. Implements the
+    subset of the faiss.Index interface used by the LangChain FAISS wrapper.
+    """
+    
+    BINARY_INDEX_FILE = "index.binary"
+    VECTORS_FILE = "vectors.npy"
+    
+    def __init__(self, binary_index: faiss.IndexBinary, vectors: np.ndarray, rerank_k: int = 100):
+        self.binary_index = binary_index
+        self.vectors = vectors
+        self.rerank_k = rerank_k
+    
+    @property
+    def d(self) -> int:
+        return self.vectors.shape[1]
+    
+    @property
+    def ntotal(self) -> int:
+        return self.binary_index.ntotal
+    
+    def search(self, xq: np.ndarray, k: int):
+        """Return (scores, labels) arrays of shape (len(xq), k), best first."""
+        xq = np.ascontiguousarray(xq, dtype=np.float32)
+        _, candidates = self.binary_index.search(_binarize(xq), max(k, self.rerank_k))
+        
+        scores = np.full((len(xq), k), -np.inf, dtype=np.float32)
+        labels = np.full((len(xq), k), -1, dtype=np.int64)
+        for i, ids in enumerate(candidates):
+            ids = np.sort(ids[ids >= 0])  # sorted ids read the mmap sequentially
+            sims = self.vectors[ids] @ xq[i]
+            top = np.argsort(-sims)[:k]
+            scores[i, :len(top)] = sims[top]
+            labels[i, :len(top)] = ids[top]
+        
+        return scores, labels
+    
+    def add(self, x: np.ndarray) -> None:
+        """Append vectors; the float matrix is copied out of its memory map."""
+        x = np.ascontiguousarray(x, dtype=np.float32)
+        self.binary_index.add(_binarize(x))
+        self.vectors = np.concatenate([self.vectors, x])
+    
+    def save(self, directory: str) -> None:
+        faiss.write_index_binary(self.binary_index, os.path.join(directory, self.BINARY_INDEX_FILE))
+        np.save(os.path.join(directory, self.VECTORS_FILE), self.vectors)
+    
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.BINARY_INDEX_FILE))
+    
+    @classmethod
+    def load(cls, directory: str) -> "BinaryRerankIndex":
+        binary_index = faiss.read_index_binary(os.path.join(directory, cls.BINARY_INDEX_FILE))
+        vectors = np.load(os.path.join(directory, cls.VECTORS_FILE), mmap_mode="r")
+        return cls(binary_index, vectors)
+
+def _create_index(xb: np.ndarray, index_type: str, nlist: int, m: int, nprobe: int):
+    """Create, train and populate a FAISS index for the given vectors.
+    
+    "ivfpq" builds an OPQ-rotated IVF-PQ index, which stores each vector as m
+    bytes and only scans nprobe inverted lists per query. "hnsw" builds an
+    HNSW graph over the uncompressed vectors, which needs no training and
+    gives high recall, and "auto" uses it for corpora below HNSW_MAX_VECTORS
+    and IVF-PQ for larger ones. "ivfflat" builds an
+    uncompressed IVF index with about 4*sqrt(N) lists, trading memory for exact
+    distances within the visited lists, and "ivfsq8" and "ivfsqfp16" build the
+    same index over scalar-quantized vectors, stored as one byte or a 16-bit
+    float per dimension (4x and 2x smaller). "binary" builds a
+    binary IVF index over sign bits with float re-ranking (see
+    BinaryRerankIndex). Corpora too small to train a coarse quantizer or
+    codebooks fall back to exhaustive search.
+    
+    Args:
+        xb (np.ndarray): (N, d) float32 matrix of embeddings
+        index_type (str): One of "auto", "hnsw", "ivfpq", "ivfflat", "ivfsq8",
+            "ivfsqfp16" or "binary"
+        nlist (int): Maximum number of IVF coarse centroids
+        m (int): Number of PQ sub-quantizers (bytes per vector)
+        nprobe (int): Number of inverted lists visited per query
+        
+    Returns:
+        Populated index using inner-product similarity
+    """
+    n, d = xb.shape
+    nlist = min(nlist, n // MIN_POINTS_PER_CENTROID)
+    
+    if index_type == "auto":
+        index_type = "hnsw" if n < HNSW_MAX_VECTORS else "ivfpq"
+    
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        index.add(xb)
+        return index
+    
+    if index_type == "binary":
+        codes = _binarize(xb)
+        if nlist < 1:
+            binary_index = faiss.IndexBinaryFlat(d)
+        else:
+            binary_index = faiss.index_binary_factory(d, f"BIVF{nlist}")
+            binary_index.train(codes)
+            binary_index.nprobe = nprobe
+        binary_index.add(codes)
+        return BinaryRerankIndex(binary_index, xb)
+    
+    if index_type in _IVF_ENCODINGS:
+        encoding = _IVF_ENCODINGS[index_type]
+        nlist = min(nlist, int(4 * math.sqrt(n)))
+        if nlist < 1:
+            if encoding == "Flat":
+                index = faiss.IndexFlatIP(d)
+            else:
+                # Scalar quantizers only train per-dimension ranges, which any N allows
+                index = faiss.index_factory(d, encoding, faiss.METRIC_INNER_PRODUCT)
+                index.train(xb)
+        else:
+            index = faiss.index_factory(d, f"IVF{nlist},{encoding}", faiss.METRIC_INNER_PRODUCT)
+            index.train(xb)
+            index.nprobe = nprobe
+        index.add(xb)
+        return index
+    
+    if index_type != "ivfpq":
+        raise ValueError(f"Unknown index type: {index_type}")
+    
+    if nlist < 1 or n < max(MIN_PQ_TRAINING_POINTS, d) or d % m:
+        index = faiss.IndexFlatIP(d)
+    else:
+        # The OPQ rotation decorrelates the PQ subspaces, so fewer bytes per
+        # vector lose less recall
+        index = faiss.index_factory(d, f"OPQ{m}_{d},IVF{nlist},PQ{m}x8", faiss.METRIC_INNER_PRODUCT)
+        # Train on a sample: the rotation is otherwise applied to every vector
+        # only for k-means to subsample them again
+        max_train = MAX_POINTS_PER_CENTROID * max(nlist, 256)
+        if n > max_train:
+            sample = np.random.default_rng(0).choice(n, max_train, replace=False)
+            index.train(xb[np.sort(sample)])
+        else:
+            index.train(xb)
+        faiss.extract_index_ivf(index).nprobe = nprobe
+    
+    index.add(xb)
+    return index
+
+def _apply_search_params(index) -> None:
+    """Override nprobe/efSearch from the FAISS_NPROBE and FAISS_EF_SEARCH env vars."""
+    if isinstance(index, BinaryRerankIndex):
+        if os.getenv("FAISS_NPROBE") and isinstance(index.binary_index, faiss.IndexBinaryIVF):
+            index.binary_index.nprobe = int(os.getenv("FAISS_NPROBE"))
+        return
+    params = faiss.ParameterSpace()
+    for name, env_var in (("nprobe", "FAISS_NPROBE"), ("efSearch", "FAISS_EF_SEARCH")):
+        value = os.getenv(env_var)
+        if value:
+            try:
+                params.set_index_parameter(index, name, int(value))
+            except RuntimeError:
+                pass  # Not a parameter of this index type
+
+# Set USE_FAISS_GPU=1 to search on the GPU when a GPU build of FAISS finds
+# devices; by default indexes stay in host memory
+USE_FAISS_GPU = os.getenv("USE_FAISS_GPU", "0") == "1"
+
+@functools.lru_cache(maxsize=1)
+def _gpu_resources() -> list:
+    """One StandardGpuResources per device, shared by every GPU index in the process."""
+    return [faiss.StandardGpuResources() for _ in range(faiss.get_num_gpus())]
+
+def _to_gpu(index):
+    """Clone a CPU index onto all available GPUs, sharded across devices.
+    
+    Returns the index unchanged unless USE_FAISS_GPU=1, and when no GPU is
+    present or the index type has no GPU implementation.
+    """
+    if not USE_FAISS_GPU or faiss.get_num_gpus() == 0 or isinstance(index, BinaryRerankIndex):
+        return index
+    
+    try:
+        options = faiss.GpuMultipleClonerOptions()
+        options.shard = True
+        return faiss.index_cpu_to_gpu_multiple_py(_gpu_resources(), index, co=options)
+    except Exception as e:
+        logger.warning(f"Could not move index to GPU, using CPU index: {e}")
+        return index
+
+def _to_cpu(index):
+    """Return a CPU copy of an index moved to the GPU by _to_gpu, else the index itself."""
+    if faiss.get_num_gpus() == 0 or not isinstance(index, (faiss.GpuIndex, faiss.IndexShards)):
+        return index
+    return faiss.index_gpu_to_cpu(index)
+
+# Files that make up a saved index; anything else in its directory is carried over
+_INDEX_FILES = {"index.faiss", "index.pkl", BinaryRerankIndex.BINARY_INDEX_FILE, BinaryRerankIndex.VECTORS_FILE}
+
+def _save_vectorstore(
+    vectorstore: FAISS,
+    persist_directory: str,
+    extra_files: Optional[Dict[str, str]] = None
+) -> None:
+    """Persist a vectorstore in the FAISS.save_local layout.
+    
+    GPU indexes are saved as their CPU copy, and the binary index in its own
+    files, which save_local cannot serialize. The index is written to a
+    scratch directory that then replaces persist_directory, so a failed save
+    leaves the previous index intact and readers never see a partial one.
+    Memory-mapped readers of the old files keep their mapping.
+    
+    Other files in persist_directory, such as main.py's manifest, are kept.
+    extra_files maps file names to text written alongside the index in the
+    same save.
     """
-    print(f"Building index from {len(documents)} documents")
+    persist_directory = os.path.abspath(persist_directory)
+    tmp_directory = f"{persist_directory}.tmp.{os.getpid()}"
+    shutil.rmtree(tmp_directory, ignore_errors=True)
+    os.makedirs(tmp_directory)
+    try:
+        if isinstance(vectorstore.index, BinaryRerankIndex):
+            vectorstore.index.save(tmp_directory)
+        else:
+            faiss.write_index(_to_cpu(vectorstore.index), os.path.join(tmp_directory, "index.faiss"))
+        # Same docstore layout as FAISS.save_local
+        with open(os.path.join(tmp_directory, "index.pkl"), "wb") as f:
+            pickle.dump((vectorstore.docstore, vectorstore.index_to_docstore_id), f)
+        
+        extra_files = extra_files or {}
+        if os.path.isdir(persist_directory):
+            for name in os.listdir(persist_directory):
+                path = os.path.join(persist_directory, name)
+                if name not in _INDEX_FILES and name not in extra_files and os.path.isfile(path):
+                    shutil.copy2(path, tmp_directory)
+        for name, text in extra_files.items():
+            with open(os.path.join(tmp_directory, name), "w") as f:
+                f.write(text)
+    except Exception:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+        raise
+    
+    # A directory can't be renamed over a non-empty one, so move the old one aside first
+    old_directory = f"{persist_directory}.old.{os.getpid()}"
+    if os.path.exists(persist_directory):
+        os.replace(persist_directory, old_directory)
+    os.replace(tmp_directory, persist_directory)
+    shutil.rmtree(old_directory, ignore_errors=True)
 
-    # Configure text splitting
+def _split_documents(documents: List[Document], chunk_size: int) -> List[Document]:
+    """Split documents into overlapping chunks for embedding."""
     text_splitter = RecursiveCharacterTextSplitter(
         chunk_size=chunk_size,
         chunk_overlap=int(chunk_size * 0.2),  # 20% overlap
         length_function=len,
         separators=["\n\n", "\n", ".", "!", "?", " ", ""]
     )
+    return text_splitter.split_documents(documents)
+
+def build_faiss_index(
+    documents: List[Document],
+    persist_directory: str,
+    chunk_size: int = 1000,
+    index_type: str = "auto",
+    nlist: int = 4096,
+    m: int = 64,
+    nprobe: int = 16,
+    extra_files: Optional[Dict[str, str]] = None
+) -> Optional[FAISS]:
+    """Build an optimized FAISS index from documents.
+    
+    Args:
+        documents (List[Document]): List of LangChain documents to index
+        persist_directory (str): Directory to save the FAISS index
+        chunk_size (int, optional): Size of text chunks. Defaults to 1000.
+        index_type (str, optional): "auto", "hnsw", "ivfpq", "ivfflat", "ivfsq8",
+            "ivfsqfp16" or "binary". Defaults to "auto".
+        nlist (int, optional): Maximum number of IVF lists. Defaults to 4096.
+        m (int, optional): Number of PQ sub-quantizers. Defaults to 64.
+        nprobe (int, optional): IVF lists searched per query. Defaults to 16.
+            Both this and HNSW's efSearch can be overridden at load time with
+            the FAISS_NPROBE and FAISS_EF_SEARCH environment variables.
+        extra_files (Optional[Dict[str, str]], optional): File names and text
+            saved into persist_directory together with the index.
+        
+    Returns:
+        Optional[FAISS]: Initialized and populated FAISS vectorstore
+    """
+    logger.debug(f"Building index from {len(documents)} documents")
 
     # Split documents into chunks
-    texts = text_splitter.split_documents(documents)
-    print(f"Created {len(texts)} text chunks")
+    texts = _split_documents(documents, chunk_size)
+    logger.debug(f"Created {len(texts)} text chunks")
 
     # Debug: Show sample chunks
     if texts:
-        print("Sample chunk:", texts[0].page_content[:200])
+        logger.debug(f"Sample chunk: {texts[0].page_content[:200]}")
 
     # Initialize embeddings
     api_key = os.getenv("OPENAI_API_KEY")
     if not api_key:
         raise ValueError("OPENAI_API_KEY environment variable not set")
         
-    embeddings = OpenAIEmbeddings(
-        model="text-embedding-ada-002",
-        openai_api_key=api_key
-    )
+    embeddings = _get_embeddings(api_key)
 
-    # Build vectorstore
-    vectorstore = FAISS.from_documents(texts, embeddings)
+    # Embed chunks and build the index directly, so the index type is ours to choose
+    xb = _embed_texts([t.page_content for t in texts])
+    _configure_faiss_threads()
+    index = _create_index(xb, index_type=index_type, nlist=nlist, m=m, nprobe=nprobe)
+    _apply_search_params(index)
+    logger.debug(f"Built {type(index).__name__} over {index.ntotal} vectors")
+
+    ids = [str(uuid.uuid4()) for _ in texts]
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, texts))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
     
-    # Save index
-    vectorstore.save_local(persist_directory)
-    print(f"Index saved to {persist_directory}")
+    # Save index, then serve searches from GPU memory when available
+    _save_vectorstore(vectorstore, persist_directory, extra_files)
+    vectorstore.index = _to_gpu(vectorstore.index)
+    logger.info(
+        f"Indexed {len(texts)} chunks from {len(documents)} documents "
+        f"into {type(index).__name__}, saved to {persist_directory}"
+    )
 
-    # Verify index
-    test_results = vectorstore.similarity_search("test", k=1)
-    print(f"Index verification: Retrieved {len(test_results)} results")
+    # Verify index (costs an embedding call, so only when debugging)
+    if os.getenv("RAG_DEBUG"):
+        test_results = vectorstore.similarity_search("test", k=1)
+        logger.debug(f"Index verification: Retrieved {len(test_results)} results")
 
     return vectorstore
 
-def load_faiss_index(persist_directory: str) -> Optional[FAISS]:
+def _remove_from_index(vectorstore: FAISS, remove_ids: List[str]) -> None:
+    """Remove chunks from a non-flat index by refilling it with the rest.
+    
+    Only flat indexes renumber their vectors on remove_ids, which LangChain's
+    delete relies on. Other index types are reset to their trained state, so
+    coarse quantizers, rotations and codebooks are kept, then refilled with
+    the kept vectors. HNSW and binary indexes store those vectors exactly and
+    are read back; PQ and SQ codes are lossy, so IVF indexes take them from
+    the embedding cache. Neither re-embeds anything.
+    """
+    removed = set(remove_ids)
+    kept = [(i, doc_id) for i, doc_id in sorted(vectorstore.index_to_docstore_id.items()) if doc_id not in removed]
+    positions = np.array([i for i, _ in kept], dtype=np.int64)
+    index = _to_cpu(vectorstore.index)
+    
+    if isinstance(index, BinaryRerankIndex):
+        binary_index = faiss.clone_binary_index(index.binary_index)
+        binary_index.reset()
+        new_index = BinaryRerankIndex(binary_index, np.empty((0, index.d), dtype=np.float32), index.rerank_k)
+        new_index.add(index.vectors[positions])
+    else:
+        if isinstance(index, faiss.IndexHNSWFlat):
+            xb = index.reconstruct_n(0, index.ntotal)[positions]
+        else:
+            xb = _embed_texts([vectorstore.docstore.search(doc_id).page_content for _, doc_id in kept])
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        new_index.add(xb)
+    
+    vectorstore.docstore.delete(list(removed))
+    vectorstore.index = _to_gpu(new_index)
+    vectorstore.index_to_docstore_id = {i: doc_id for i, (_, doc_id) in enumerate(kept)}
+
+def update_faiss_index(
+    vectorstore: FAISS,
+    documents: List[Document],
+    remove_paths: List[str],
+    persist_directory: str,
+    chunk_size: int = 1000,
+    extra_files: Optional[Dict[str, str]] = None
+) -> FAISS:
+    """Apply document additions and removals to an existing index and save it.
+    
+    Chunks whose source path is in `remove_paths` are deleted, then the new
+    documents are chunked, embedded and appended. Flat indexes delete in
+    place; other types are refilled with their remaining vectors (see
+    _remove_from_index), so no chunk is embedded again.
+    
+    Args:
+        vectorstore (FAISS): Vectorstore loaded with mmap=False
+        documents (List[Document]): New or changed documents to add
+        remove_paths (List[str]): Source paths whose chunks should be removed
+        persist_directory (str): Directory to save the updated index to
+        chunk_size (int, optional): Size of text chunks. Defaults to 1000.
+        extra_files (Optional[Dict[str, str]], optional): File names and text
+            saved into persist_directory together with the index.
+        
+    Returns:
+        FAISS: The updated vectorstore
+    """
+    remove_paths = set(remove_paths)
+    remove_ids = [
+        doc_id for doc_id in vectorstore.index_to_docstore_id.values()
+        if vectorstore.docstore.search(doc_id).metadata.get("path") in remove_paths
+    ]
+    if remove_ids:
+        if isinstance(vectorstore.index, faiss.IndexFlat):
+            vectorstore.delete(remove_ids)
+        else:
+            _remove_from_index(vectorstore, remove_ids)
+    
+    texts = _split_documents(documents, chunk_size)
+    if texts:
+        xb = _embed_texts([t.page_content for t in texts])
+        vectorstore.add_embeddings(
+            zip([t.page_content for t in texts], xb),
+            metadatas=[t.metadata for t in texts],
+            ids=[str(uuid.uuid4()) for _ in texts]
+        )
+    
+    _save_vectorstore(vectorstore, persist_directory, extra_files)
+    logger.info(
+        f"Updated index in {persist_directory}: removed {len(remove_ids)} chunks, "
+        f"added {len(texts)} chunks from {len(documents)} documents"
+    )
+    return vectorstore
+
+def _read_index(path: str, mmap: bool) -> faiss.Index:
+    """Read a FAISS index, memory-mapping its data when requested and supported."""
+    if mmap:
+        try:
+            return faiss.read_index(path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError as e:
+            logger.warning(f"Could not memory-map index, reading it into memory: {e}")
+    return faiss.read_index(path)
+
+def load_faiss_index(persist_directory: str, mmap: bool = True) -> Optional[FAISS]:
     """Load a FAISS index from disk.
     
+    Memory-mapped loads are cached per process, so repeated calls return the
+    same vectorstore until the index on disk is rewritten. Failed loads are
+    not cached. mmap=False loads are meant to be modified, so each call reads
+    a private copy that concurrent updates and failed ones can't share.
+    
     Args:
         persist_directory (str): Directory containing the FAISS index
+        mmap (bool): Memory-map the index read-only, so pages are faulted in on
+            demand and shared between processes. Mapped IVF indexes cannot be
+            modified; pass False to add documents to the loaded index.
         
     Returns:
         Optional[FAISS]: Loaded FAISS vectorstore or None if loading fails
     """
+    try:
+        persist_directory = os.path.abspath(persist_directory)
+        # The docstore is rewritten by every save, so its mtime identifies the index version
+        version = os.path.getmtime(os.path.join(persist_directory, "index.pkl"))
+        if not mmap:
+            return _load_faiss_index.__wrapped__(persist_directory, mmap, version)
+        return _load_faiss_index(persist_directory, mmap, version)
+    except Exception as e:
+        logger.error(f"Error loading index: {e}")
+        return None
+
+@functools.lru_cache(maxsize=4)
+def _load_faiss_index(persist_directory: str, mmap: bool, version: float) -> FAISS:
+    """Load a FAISS index from disk, raising on failure. load_faiss_index caches mmap loads."""
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY environment variable not set")
+        
+    embeddings = _get_embeddings(api_key)
+    
+    _configure_faiss_threads()
+    
+    if BinaryRerankIndex.exists(persist_directory):
+        index = BinaryRerankIndex.load(persist_directory)
+    else:
+        index = _read_index(os.path.join(persist_directory, "index.faiss"), mmap=mmap)
+    _apply_search_params(index)
+    
+    # Same docstore layout as FAISS.save_local
+    with open(os.path.join(persist_directory, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=docstore,
+        index_to_docstore_id=index_to_docstore_id,
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+    )
+    
+    # Serve searches from GPU memory when available
+    vectorstore.index = _to_gpu(vectorstore.index)
+    
+    # Verify loaded index (costs an embedding call, so only when debugging)
+    if os.getenv("RAG_DEBUG"):
+        test_results = vectorstore.similarity_search("test", k=1)
+        logger.debug(f"Index verification: Retrieved {len(test_results)} results")
+    logger.debug(f"Successfully loaded index with {vectorstore.index.ntotal} vectors")
+    
+    return vectorstore
+
+def warm_up(persist_directory: Optional[str] = None) -> bool:
+    """Pay first-query costs ahead of time.
+    
+    Opens the pooled embeddings connection with one query embedding and, if
+    an index exists in persist_directory, loads it and runs a search so its
+    pages and the loaded-index cache are warm.
+    
+    Args:
+        persist_directory (Optional[str]): Directory of the index to warm up
+        
+    Returns:
+        bool: Whether warm-up succeeded
+    """
     try:
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise ValueError("OPENAI_API_KEY environment variable not set")
-            
-        embeddings = OpenAIEmbeddings(
-            model="text-embedding-ada-002",
-            openai_api_key=api_key
-        )
-        
-        vectorstore = FAISS.load_local(
-            persist_directory, 
-            embeddings,
-            allow_dangerous_deserialization=True
-        )
+        _get_embeddings(api_key).embed_query("warmup")
         
-        # Verify loaded index
-        test_results = vectorstore.similarity_search("test", k=1)
-        print(f"Successfully loaded index with {len(test_results)} test results")
-        
-        return vectorstore
+        if persist_directory and os.path.exists(os.path.join(persist_directory, "index.pkl")):
+            vectorstore = load_faiss_index(persist_directory)
+            if vectorstore:
+                vectorstore.similarity_search("warmup", k=1)
+        return True
     except Exception as e:
-        print(f"Error loading index: {e}")
-        return None
-
+        logger.warning(f"Warm-up failed: {e}")
+        return False
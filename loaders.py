@@ -1,28 +1,65 @@
 from langchain.schema import Document as LangchainDocument
-from PyPDF2 import PdfReader
+import pypdfium2 as pdfium
 from docx import Document
-from dspy_pipeline import IEPPipeline
+from docx.oxml.ns import qn
+import io
 import os
-from typing import List, Optional
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Iterator, List, Optional
+from diskcache import Cache
+import functools
+import hashlib
+import multiprocessing
+import pickle
 import logging
 import re
 
 logger = logging.getLogger(__name__)
 
-def process_with_dspy(documents: List[LangchainDocument]) -> List[LangchainDocument]:
-    """Process documents using the DSPy pipeline.
-    
-    Args:
-        documents (List[LangchainDocument]): List of documents to process
-        
-    Returns:
-        List[LangchainDocument]: Processed documents with enhanced content
-    """
-    iep_pipeline = IEPPipeline()
-    results = []
+# Character-level artifacts removed by clean_text in a single scan, and the
+# replacement for each alternative
+_ARTIFACTS = re.compile(
+    r'(?P<nonascii>[^\x00-\x7F]+)'
+    r'|(?P<tildes>[~`]{2,})'
+    r'|(?P<rpunct>[.:;,]{2,})'
+)
+_ARTIFACT_REPLACEMENTS = {'nonascii': ' ', 'tildes': '', 'rpunct': '.'}
 
-    for doc in documents:
-        try:
+# Control characters deleted with str.translate. Those that count as whitespace
+# (\x0b, \x0c, \x1c-\x1f) are left to whitespace normalization, and \x80-\xff
+# are already replaced as non-ASCII.
+_CONTROL_CHARS = dict.fromkeys([*range(0x00, 0x09), *range(0x0E, 0x1C), 0x7F])
+
+# Whitespace normalization, applied after artifacts are removed
+_WHITESPACE = re.compile(r'\s+')
+_ESCAPED_NEWLINES = re.compile(r'\\n+')
+_PARAGRAPH_BREAK = re.compile(r'\n\s*\n')
+
+# Worker processes used to parse files. 1 parses serially in-process, which
+# suits spinning disks where concurrent reads thrash the heads.
+_USABLE_CPUS = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+LOAD_DOCUMENTS_WORKERS = int(os.getenv("LOAD_DOCUMENTS_WORKERS", str(_USABLE_CPUS)))
+
+# Enhanced content from previous runs, keyed by a hash of the original content
+_DSPY_CACHE = Cache(".cache/dspy")
+
+def _content_metadata(text: str) -> dict:
+    """Compute the content hash and byte length stored in document metadata."""
+    data = text.encode("utf-8", "ignore")
+    return {"hash": hashlib.blake2b(data, digest_size=16).hexdigest(), "length": len(data)}
+
+def _content_hash(doc: LangchainDocument) -> str:
+    """Hash of a document's content, taken from its metadata when available."""
+    return doc.metadata.get("hash") or _content_metadata(doc.page_content)["hash"]
+
+def _enhance_with_dspy(doc: LangchainDocument, iep_pipeline) -> LangchainDocument:
+    """Enhance a single document with DSPy, falling back to the original on error."""
+    try:
+        key = _content_hash(doc)
+        enhanced_content = _DSPY_CACHE.get(key)
+        if enhanced_content is None:
             # Process with DSPy
             iep_result = iep_pipeline.forward(doc.page_content)
             
@@ -40,40 +77,249 @@ Important Entities:
 Summary:
 {iep_result['summary']}
 """
-            
-            # Create new document with enhanced content
-            results.append(LangchainDocument(
-                page_content=enhanced_content,
-                metadata={
-                    **doc.metadata,
-                    "processed_with": "dspy",
-                    "has_enhanced_content": True
-                }
-            ))
-            print(f"Successfully processed document with DSPy: {doc.metadata.get('source')}")
-            
-        except Exception as e:
-            print(f"Error processing document with DSPy: {e}")
-            # Fall back to original document if processing fails
-            results.append(doc)
+            _DSPY_CACHE.set(key, enhanced_content)
+        
+        logger.debug("Successfully processed document with DSPy: %s", doc.metadata.get('source'))
+        
+        # Create new document with enhanced content
+        return LangchainDocument(
+            page_content=enhanced_content,
+            metadata={
+                **doc.metadata,
+                "processed_with": "dspy",
+                "has_enhanced_content": True
+            }
+        )
+        
+    except Exception as e:
+        logger.warning("Error processing document with DSPy: %s", e)
+        # Fall back to original document if processing fails
+        return doc
 
-    return results
+def process_with_dspy(documents: List[LangchainDocument]) -> List[LangchainDocument]:
+    """Process documents using the DSPy pipeline.
+    
+    Args:
+        documents (List[LangchainDocument]): List of documents to process
+        
+    Returns:
+        List[LangchainDocument]: Processed documents with enhanced content
+    """
+    # Only set up the pipeline if some documents have no cached enhanced content.
+    # Imported here so loading documents without DSPy doesn't pay for importing it.
+    iep_pipeline = None
+    if any(_content_hash(doc) not in _DSPY_CACHE for doc in documents):
+        from dspy_pipeline import IEPPipeline
+        iep_pipeline = IEPPipeline()
+    
+    # LLM calls are network-bound, so overlap them; map preserves document order
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        return list(executor.map(lambda doc: _enhance_with_dspy(doc, iep_pipeline), documents))
 
 def clean_text(text):
     """Clean extracted text by removing common OCR artifacts and formatting issues."""
-    # Remove non-standard characters and formatting artifacts
-    text = re.sub(r'[^\x00-\x7F]+', ' ', text)  # Remove non-ASCII characters
-    text = re.sub(r'[.:;,]{2,}', '.', text)     # Clean up repeated punctuation
-    text = re.sub(r'\s+', ' ', text)            # Normalize whitespace
-    text = re.sub(r'\\n+', '\n', text)          # Normalize newlines
-    text = re.sub(r'\n\s*\n', '\n\n', text)     # Normalize paragraph breaks
+    # Remove non-ASCII characters, OCR artifacts and repeated punctuation in one
+    # pass, then delete control characters
+    text = _ARTIFACTS.sub(lambda match: _ARTIFACT_REPLACEMENTS[match.lastgroup], text)
+    text = text.translate(_CONTROL_CHARS)
     
-    # Remove common OCR artifacts
-    text = re.sub(r'[~`]{2,}', '', text)
-    text = re.sub(r'[\x00-\x08\x0B\x0C\x0E-\x1F\x7F-\xFF]', '', text)
+    # Normalize whitespace, newlines and paragraph breaks
+    text = _WHITESPACE.sub(' ', text)
+    text = _ESCAPED_NEWLINES.sub('\n', text)
+    text = _PARAGRAPH_BREAK.sub('\n\n', text)
     
     return text.strip()
 
+_W_P = qn("w:p")
+_W_T = qn("w:t")
+# Run content rendered as whitespace, as python-docx does
+_W_BREAKS = {qn("w:tab"): "\t", qn("w:br"): "\n", qn("w:cr"): "\n"}
+
+def _docx_paragraph_texts(body) -> Iterator[str]:
+    """Yield the text of every paragraph in a DOCX body, in document order.
+    
+    Table cell paragraphs are included. Paragraphs nested in another one, as
+    in text boxes, are part of the outer paragraph's text, on their own line.
+    """
+    for p in body.iter(_W_P):
+        if next(p.iterancestors(_W_P), None) is not None:
+            continue
+        parts = []
+        for el in p.iter(_W_T, _W_P, *_W_BREAKS):
+            if el.tag == _W_T:
+                parts.append(el.text or "")
+            elif el.tag == _W_P:
+                if el is not p:
+                    parts.append("\n")
+            else:
+                parts.append(_W_BREAKS[el.tag])
+        yield "".join(parts)
+
+def _pdf_page_texts(pdf: pdfium.PdfDocument) -> Iterator[str]:
+    """Yield the raw text of each page, releasing every page once it's read."""
+    for page in pdf:
+        textpage = page.get_textpage()
+        try:
+            yield textpage.get_text_range()
+        finally:
+            textpage.close()
+            page.close()
+
+def _parse_file(file_path: str, file: str, data: Optional[bytes] = None) -> Optional[LangchainDocument]:
+    """Extract and clean the text of a single file.
+    
+    Args:
+        file_path (str): Path to the file
+        file (str): File name, used as the document source
+        data (Optional[bytes]): File contents, parsed in memory instead of
+            reading file_path, which is then only recorded in the metadata
+        
+    Returns:
+        Optional[LangchainDocument]: Parsed document, or None if the file is
+            unsupported, empty or fails to parse
+    """
+    logger.debug("Processing file: %s", file_path)
+    
+    try:
+        if file.endswith((".docx", ".doc")):
+            doc = Document(io.BytesIO(data) if data is not None else file_path)
+            # Walk the XML for every paragraph in document order, including
+            # those inside tables that doc.paragraphs skips
+            text = "\n".join(para for para in _docx_paragraph_texts(doc.element.body) if para)
+            text = clean_text(text)
+            logger.debug("Extracted %d characters from DOCX", len(text))
+            if text.strip():  # Only add if there's actual content
+                return LangchainDocument(
+                    page_content=text, 
+                    metadata={
+                        "source": file,
+                        "type": "docx",
+                        "path": file_path,
+                        **_content_metadata(text)
+                    }
+                )
+        
+        elif file.endswith(".pdf"):
+            # Pages are extracted serially: PDFium is not thread-safe, so a page-level
+            # thread pool would only contend on pypdfium2's lock. Parallelism comes
+            # from parsing separate files in separate processes instead.
+            pdf = pdfium.PdfDocument(data if data is not None else file_path)
+            try:
+                n_pages = len(pdf)
+                text = "\n\n".join(clean_text(t) for t in _pdf_page_texts(pdf) if t)
+            finally:
+                pdf.close()
+            
+            logger.debug("Extracted %d characters from PDF", len(text))
+            if text.strip():  # Only add if there's actual content
+                return LangchainDocument(
+                    page_content=text, 
+                    metadata={
+                        "source": file,
+                        "type": "pdf",
+                        "path": file_path,
+                        "pages": n_pages,
+                        **_content_metadata(text)
+                    }
+                )
+        
+        elif file.endswith((".txt", ".md")):
+            # One read plus a bulk decode, rather than text-mode incremental decoding
+            if data is None:
+                data = Path(file_path).read_bytes()
+            text = data.decode('utf-8', errors='replace')
+            text = clean_text(text)
+            logger.debug("Extracted %d characters from %s", len(text), file.split('.')[-1].upper())
+            if text.strip():  # Only add if there's actual content
+                return LangchainDocument(
+                    page_content=text, 
+                    metadata={
+                        "source": file,
+                        "type": "text",
+                        "path": file_path,
+                        **_content_metadata(text)
+                    }
+                )
+        
+    except Exception as e:
+        logger.warning("Error processing file %s: %s", file, e)
+    
+    return None
+
+# Parsed documents from previous runs, keyed by absolute file path and
+# invalidated when a file's size or modification time changes
+_DOC_CACHE_PATH = os.path.join("models", "doc_cache.pkl")
+# Bump when _parse_file or clean_text change their output, so documents
+# parsed by the old code are not served from the cache
+_DOC_CACHE_VERSION = 2
+
+def _load_doc_cache() -> dict:
+    """Load the parsed-document cache, or an empty one if missing, unreadable or stale."""
+    try:
+        with open(_DOC_CACHE_PATH, "rb") as f:
+            version, cache = pickle.load(f)
+    except Exception:
+        return {}
+    return cache if version == _DOC_CACHE_VERSION else {}
+
+def _save_doc_cache(cache: dict) -> None:
+    """Atomically persist the parsed-document cache."""
+    try:
+        os.makedirs(os.path.dirname(_DOC_CACHE_PATH), exist_ok=True)
+        tmp_path = f"{_DOC_CACHE_PATH}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump((_DOC_CACHE_VERSION, cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, _DOC_CACHE_PATH)
+    except Exception as e:
+        logger.warning("Could not save document cache: %s", e)
+
+@functools.lru_cache(maxsize=1)
+def _parse_pool() -> ProcessPoolExecutor:
+    """Worker processes for parse_files, started once per process.
+    
+    Workers are started with forkserver (or spawn), never fork: the app runs
+    threads, such as Streamlit's and the search batcher's loop, and forking
+    while they hold locks can deadlock the child.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(max_workers=LOAD_DOCUMENTS_WORKERS, mp_context=multiprocessing.get_context(method))
+
+def parse_files(parse: Callable, *args: list) -> list:
+    """Apply a parser to each file's arguments, in parallel processes.
+    
+    PDF and DOCX extraction is CPU-bound and holds the GIL, so processes scale
+    where threads wouldn't. A single file, or LOAD_DOCUMENTS_WORKERS=1, is
+    parsed in this process.
+    
+    Args:
+        parse (Callable): Picklable parser, e.g. _parse_file
+        *args (list): One list per parser argument, with an item per file
+        
+    Returns:
+        list: The parser's results, in file order
+    """
+    if min(len(args[0]), LOAD_DOCUMENTS_WORKERS) <= 1:
+        return list(map(parse, *args))
+    try:
+        return list(_parse_pool().map(parse, *args))
+    except BrokenProcessPool:
+        _parse_pool.cache_clear()  # A worker died; start a fresh pool next time
+        raise
+
+def load_documents_from_bytes(name: str, data: bytes) -> List[LangchainDocument]:
+    """Load a document from in-memory file contents, e.g. an upload.
+    
+    Args:
+        name (str): File name; its extension selects the parser
+        data (bytes): File contents
+        
+    Returns:
+        List[LangchainDocument]: The parsed document, or an empty list if the
+            file is unsupported, empty or fails to parse
+    """
+    doc = _parse_file(name, name, data)
+    return [doc] if doc else []
+
 def load_documents(data_path: str, use_dspy: bool = False) -> List[LangchainDocument]:
     """Load documents and optionally process them with DSPy.
     
@@ -85,90 +331,66 @@ def load_documents(data_path: str, use_dspy: bool = False) -> List[LangchainDocu
         List[LangchainDocument]: List of processed documents
     """
     docs = []
-    print(f"Scanning directory: {data_path}")
+    logger.info("Scanning directory: %s", data_path)
     
     if not os.path.exists(data_path):
-        print(f"Directory does not exist: {data_path}")
+        logger.warning("Directory does not exist: %s", data_path)
         return docs
 
-    # Load documents as before
-    for file in os.listdir(data_path):
-        file_path = os.path.join(data_path, file)
-        print(f"Processing file: {file_path}")
-        
-        try:
-            if file.endswith((".docx", ".doc")):
-                doc = Document(file_path)
-                text = "\n".join([para.text for para in doc.paragraphs])
-                text = clean_text(text)
-                print(f"Extracted {len(text)} characters from DOCX")
-                if text.strip():  # Only add if there's actual content
-                    docs.append(LangchainDocument(
-                        page_content=text, 
-                        metadata={
-                            "source": file,
-                            "type": "docx",
-                            "path": file_path
-                        }
-                    ))
-            
-            elif file.endswith(".pdf"):
-                reader = PdfReader(file_path)
-                text_parts = []
-                for page in reader.pages:
-                    text = page.extract_text()
-                    if text:
-                        text = clean_text(text)
-                        text_parts.append(text)
-                
-                text = "\n\n".join(text_parts)
-                print(f"Extracted {len(text)} characters from PDF")
-                if text.strip():  # Only add if there's actual content
-                    docs.append(LangchainDocument(
-                        page_content=text, 
-                        metadata={
-                            "source": file,
-                            "type": "pdf",
-                            "path": file_path,
-                            "pages": len(reader.pages)
-                        }
-                    ))
-            
-            elif file.endswith((".txt", ".md")):
-                with open(file_path, "r", encoding='utf-8') as file_content:
-                    text = file_content.read()
-                    text = clean_text(text)
-                    print(f"Extracted {len(text)} characters from {file.split('.')[-1].upper()}")
-                    if text.strip():  # Only add if there's actual content
-                        docs.append(LangchainDocument(
-                            page_content=text, 
-                            metadata={
-                                "source": file,
-                                "type": "text",
-                                "path": file_path
-                            }
-                        ))
-            
-        except Exception as e:
-            print(f"Error processing file {file}: {str(e)}")
-            continue
+    # Reuse documents parsed on a previous run if the file hasn't changed
+    data_dir = os.path.abspath(data_path)
+    with os.scandir(data_path) as it:
+        entries = {os.path.join(data_dir, entry.name): entry for entry in it if entry.is_file()}
+    stats = {path: (entry.stat().st_size, entry.stat().st_mtime_ns) for path, entry in entries.items()}
+    cache = _load_doc_cache()
+    stale = [path for path, stat in stats.items() if path not in cache or cache[path][0] != stat]
+    # Forget files that were deleted, including those in other (e.g. temporary) directories
+    removed = [path for path in cache
+               if path not in stats and (os.path.dirname(path) == data_dir or not os.path.exists(path))]
+    
+    # Parse the rest in parallel
+    if stale:
+        file_paths = [entries[path].path for path in stale]
+        files = [entries[path].name for path in stale]
+        for path, doc in zip(stale, parse_files(_parse_file, file_paths, files)):
+            cache[path] = (stats[path], doc)
     
-    print(f"Total documents loaded: {len(docs)}")
+    if stale or removed:
+        for path in removed:
+            del cache[path]
+        _save_doc_cache(cache)
+    
+    docs = [cache[path][1] for path in stats if cache[path][1]]
+    logger.info("Loaded %d documents (%d files parsed, %d from cache)",
+                len(docs), len(stale), len(stats) - len(stale))
+    
+    # Drop documents whose content duplicates an earlier one (e.g. the same file
+    # under two names), so each is only processed and embedded once
+    seen = set()
+    unique_docs = []
+    for doc in docs:
+        content_hash = _content_hash(doc)
+        if content_hash in seen:
+            logger.info("Skipping duplicate content in %s", doc.metadata.get('source', 'unknown'))
+            continue
+        seen.add(content_hash)
+        unique_docs.append(doc)
+    docs = unique_docs
     
     # Process with DSPy if requested
     if use_dspy and docs:
-        print("Processing documents with DSPy pipeline...")
+        logger.info("Processing documents with DSPy pipeline...")
         docs = process_with_dspy(docs)
-        print(f"DSPy processing complete. Processed {len(docs)} documents.")
+        logger.info("DSPy processing complete. Processed %d documents.", len(docs))
     
     if docs:
-        print("Sample content from first document:")
-        print(docs[0].page_content[:200] + "...")
+        logger.debug("Sample content from first document: %s...", docs[0].page_content[:200])
     
     # Verify loaded documents
-    for doc in docs:
-        if not doc.page_content or not isinstance(doc.page_content, str):
-            logger.warning(f"Invalid document content in {doc.metadata.get('source', 'unknown')}")
-            docs.remove(doc)
+    valid_docs = [doc for doc in docs if isinstance(doc.page_content, str) and doc.page_content]
+    if len(valid_docs) < len(docs):
+        for doc in docs:
+            if not doc.page_content or not isinstance(doc.page_content, str):
+                logger.warning(f"Invalid document content in {doc.metadata.get('source', 'unknown')}")
             
-    return docs
\ No newline at end of file
+    return valid_docs
\ No newline at end of file
@@ -1,16 +1,60 @@
 from loaders import load_documents
-from embeddings import build_faiss_index, load_faiss_index
-from dspy_pipeline import build_faiss_index_with_dspy
+from embeddings import build_faiss_index, load_faiss_index, update_faiss_index
 from chains import build_rag_chain
+from langchain.schema import Document as LangchainDocument
 import os
-import shutil
-from typing import Optional, Dict, Any
+import json
+import tempfile
+from typing import Optional, Dict, Any, List
 import logging
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Sizes and mtimes of the data files the index was built from
+MANIFEST_FILE = "manifest.json"
+
+def _scan_data_dir(data_dir: str) -> Dict[str, List[int]]:
+    """Map each file in the data directory to its [size, mtime_ns]."""
+    with os.scandir(data_dir) as it:
+        return {
+            entry.path: [entry.stat().st_size, entry.stat().st_mtime_ns]
+            for entry in it if entry.is_file()
+        }
+
+def _read_manifest(index_dir: str) -> Optional[Dict[str, List[int]]]:
+    """Read the index manifest, or None if there is no usable one."""
+    try:
+        with open(os.path.join(index_dir, MANIFEST_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _manifest_files(manifest: Dict[str, List[int]]) -> Dict[str, str]:
+    """The manifest as extra_files, saved atomically with the index it describes."""
+    return {MANIFEST_FILE: json.dumps(manifest)}
+
+def _update_index(vectorstore: Any, data_dir: str, index_dir: str,
+                  manifest: Dict[str, List[int]], current: Dict[str, List[int]]) -> Optional[Any]:
+    """Bring a loaded index up to date with the data directory.
+    
+    Only files that were added, changed or deleted since the manifest was
+    written are re-embedded or removed. Returns None if the index could not
+    be updated in place and needs a full rebuild.
+    """
+    to_add = {path for path, stat in current.items() if manifest.get(path) != stat}
+    to_remove = [path for path, stat in manifest.items() if current.get(path) != stat]
+    logger.info(f"Data directory changed: {len(to_add)} new or modified, "
+                f"{len(set(manifest) - set(current))} deleted files")
+    try:
+        # The document cache makes this cheap for files that haven't changed
+        documents = [doc for doc in load_documents(data_dir)
+                     if doc.metadata.get("path") in to_add]
+        return update_faiss_index(vectorstore, documents, to_remove, index_dir,
+                                  extra_files=_manifest_files(current))
+    except Exception as e:
+        logger.warning(f"Could not update index in place, rebuilding: {e}")
+        return None
+
 def initialize_qa_chain(
     use_dspy: bool = False,
     rebuild_index: bool = False,
@@ -44,21 +88,30 @@ def initialize_qa_chain(
             logger.error("DATA_DIR does not exist!")
             return None
 
-        # 3. Try to load existing index
+        # 3. Try to load existing index, applying any changes to the data
+        # directory since the manifest was written
         vectorstore = None
+        current = _scan_data_dir(DATA_DIR)
         if not rebuild_index and os.path.exists(INDEX_DIR):
-            logger.info("Attempting to load existing FAISS index...")
-            vectorstore = load_faiss_index(INDEX_DIR)
-            if vectorstore:
-                logger.info("Successfully loaded existing FAISS index")
+            manifest = _read_manifest(INDEX_DIR)
+            if manifest is None:
+                # Unknown which data files the index holds, so rebuild it
+                logger.info("No index manifest found, rebuilding")
+            elif manifest == current:
+                logger.info("Attempting to load existing FAISS index...")
+                vectorstore = load_faiss_index(INDEX_DIR)
+                if vectorstore:
+                    logger.info("Successfully loaded existing FAISS index")
+            elif not use_dspy:
+                # Memory-mapped indexes are read-only
+                vectorstore = load_faiss_index(INDEX_DIR, mmap=False)
+                if vectorstore:
+                    vectorstore = _update_index(vectorstore, DATA_DIR, INDEX_DIR, manifest, current)
 
         # 4. Build new index if needed
         if vectorstore is None:
+            # The existing index is replaced only once the new one is saved
             logger.info("Building new FAISS index...")
-            # Clear existing index
-            if os.path.exists(INDEX_DIR):
-                shutil.rmtree(INDEX_DIR)
-            os.makedirs(INDEX_DIR)
             
             # Load and process documents
             documents = load_documents(DATA_DIR, use_dspy=use_dspy)
@@ -70,13 +123,15 @@ def initialize_qa_chain(
             
             # Build index with or without DSPy
             if use_dspy:
+                from dspy_pipeline import build_faiss_index_with_dspy
                 vectorstore = build_faiss_index_with_dspy(
                     documents, 
                     INDEX_DIR,
-                    model_name=model_name
+                    model_name=model_name,
+                    extra_files=_manifest_files(current)
                 )
             else:
-                vectorstore = build_faiss_index(documents, INDEX_DIR)
+                vectorstore = build_faiss_index(documents, INDEX_DIR, extra_files=_manifest_files(current))
             
             if not vectorstore:
                 logger.error("Failed to build vector store!")
@@ -108,7 +163,7 @@ def check_system_health():
         "directories": False,
         "document_loading": False,
         "vectorstore": False,
-        "chain": False,
+        "retrieval": False,
         "dspy": False
     }
     
@@ -124,22 +179,20 @@ def check_system_health():
         os.makedirs(INDEX_DIR, exist_ok=True)
         status["directories"] = os.path.exists(DATA_DIR) and os.path.exists(INDEX_DIR)
         
-        # Check document loading
-        test_doc = "This is a test document."
-        with open(os.path.join(DATA_DIR, "test.txt"), "w") as f:
-            f.write(test_doc)
-        docs = load_documents(DATA_DIR)
+        # Check document creation and indexing on an in-memory test document,
+        # in a scratch index directory so the real data and index are untouched
+        docs = [LangchainDocument(page_content="This is a test document.", metadata={"source": "test.txt"})]
         status["document_loading"] = len(docs) > 0
         
         # Check vectorstore
-        vectorstore = build_faiss_index(docs, INDEX_DIR)
-        status["vectorstore"] = vectorstore is not None
+        with tempfile.TemporaryDirectory() as health_index_dir:
+            vectorstore = build_faiss_index(docs, health_index_dir)
+            status["vectorstore"] = vectorstore is not None
         
-        # Check chain
+        # Check retrieval with a plain search; a chain would start a query
+        # batcher and spend a completion just to answer "test"
         if vectorstore:
-            chain = build_rag_chain(vectorstore)
-            test_response = chain({"query": "test"})
-            status["chain"] = "result" in test_response
+            status["retrieval"] = len(vectorstore.similarity_search("test", k=1)) > 0
         
         # Check DSPy
         try:
@@ -148,9 +201,6 @@ def check_system_health():
             status["dspy"] = True
         except:
             status["dspy"] = False
-            
-        # Cleanup test file
-        os.remove(os.path.join(DATA_DIR, "test.txt"))
         
     except Exception as e:
         logger.error(f"Health check error: {e}")
@@ -158,6 +208,9 @@ def check_system_health():
     return status
 
 if __name__ == "__main__":
+    # Configured here rather than on import, so importers keep their own setup
+    logging.basicConfig(level=logging.WARNING)
+    
     # Initialize chain with configurable options
     qa_chain = initialize_qa_chain(
         use_dspy=False,  # Set to True to enable DSPy processing
@@ -1,13 +1,14 @@
 import streamlit as st
-from chains import build_rag_chain
-from embeddings import build_faiss_index, load_faiss_index
-from loaders import load_documents
+from chains import build_rag_chain, run_rag_query, submit_rag_query, submit_rag_queries
+from embeddings import build_faiss_index, load_faiss_index, update_faiss_index, warm_up
+from loaders import load_documents_from_bytes, parse_files
 from dspy_pipeline import IEPPipeline, LessonPlanPipeline
+from main import check_system_health
 import os
-import tempfile
 import shutil
-import time
 import json
+import orjson
+import hashlib
 from datetime import datetime
 from langchain.schema import Document
 from reportlab.lib import colors
@@ -15,7 +16,13 @@ from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 import io
+import uuid
 import zipfile
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+logger = logging.getLogger(__name__)
 
 # Page Configuration
 st.set_page_config(
@@ -27,9 +34,44 @@ st.set_page_config(
 # Initialize directories
 DATA_DIR = "data"
 INDEX_DIR = "models/faiss_index"
+# Hashes of uploaded files already in the index
+INGESTED_PATH = "models/ingested.json"
 os.makedirs(DATA_DIR, exist_ok=True)
 os.makedirs(INDEX_DIR, exist_ok=True)
 
+# Most recent items kept per session, so long sessions don't grow without bound
+MAX_SESSION_DOCUMENTS = 128
+MAX_SESSION_LESSON_PLANS = 32
+# Answer multi-line chat messages as one concurrent batch of questions
+BATCH_CHAT = os.getenv("BATCH_CHAT", "0") == "1"
+
+class SessionLRU(OrderedDict):
+    """Mapping that keeps only the `maxlen` most recently added items."""
+    
+    def __init__(self, maxlen=32):
+        super().__init__()
+        self.maxlen = maxlen
+    
+    def add(self, key, value):
+        """Add or refresh an item, evicting the oldest beyond maxlen."""
+        self[key] = value
+        self.move_to_end(key)
+        while len(self) > self.maxlen:
+            self.popitem(last=False)
+
+def _load_ingested_hashes():
+    """Hashes of the uploads already in the index, persisted across sessions."""
+    try:
+        with open(INGESTED_PATH) as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+def _save_ingested_hashes(hashes):
+    """Persist the hashes of the uploads in the index."""
+    with open(INGESTED_PATH, "w") as f:
+        json.dump(sorted(hashes), f)
+
 # Initialize session state
 if "chain" not in st.session_state:
     st.session_state["chain"] = None
@@ -40,78 +82,257 @@ if "messages" not in st.session_state:
 if "iep_results" not in st.session_state:
     st.session_state["iep_results"] = []
 if "documents" not in st.session_state:
-    st.session_state["documents"] = []
+    st.session_state["documents"] = SessionLRU(MAX_SESSION_DOCUMENTS)
 if "lesson_plans" not in st.session_state:
-    st.session_state["lesson_plans"] = []
+    st.session_state["lesson_plans"] = SessionLRU(MAX_SESSION_LESSON_PLANS)
+if "lesson_plan_pdfs" not in st.session_state:
+    st.session_state["lesson_plan_pdfs"] = SessionLRU(MAX_SESSION_LESSON_PLANS)
+if "handled_uploads" not in st.session_state:
+    st.session_state["handled_uploads"] = set()
+if "ingested_hashes" not in st.session_state:
+    st.session_state["ingested_hashes"] = _load_ingested_hashes()
 
-def process_uploaded_file(uploaded_file, use_dspy=False):
-    """Process an uploaded file and update the RAG chain."""
-    with tempfile.TemporaryDirectory() as temp_dir:
-        temp_file_path = os.path.join(temp_dir, uploaded_file.name)
-        
-        # Save uploaded file
-        with open(temp_file_path, "wb") as f:
-            f.write(uploaded_file.getvalue())
-        
-        # Debug print
-        print(f"Processing file: {uploaded_file.name}")
-        
-        # Load documents
-        documents = load_documents(temp_dir)
-        if not documents:
-            st.error("No text could be extracted from the uploaded file.")
-            return False
-        
-        # Store documents in session state
-        st.session_state["documents"].extend(documents)
-        
-        # Build index
-        if os.path.exists(INDEX_DIR):
-            shutil.rmtree(INDEX_DIR)
-        os.makedirs(INDEX_DIR)
-        
-        vectorstore = build_faiss_index(documents, INDEX_DIR)
-        
+@st.cache_resource
+def get_iep_pipeline(api_key_hash):
+    """Build the IEP pipeline once per process and API key (see _api_key_hash)."""
+    return IEPPipeline()
+
+@st.cache_resource
+def get_lesson_plan_pipeline(api_key_hash):
+    """Build the lesson plan pipeline once per process and API key (see _api_key_hash)."""
+    return LessonPlanPipeline()
+
+@st.cache_resource(show_spinner=False)
+def warmup(api_key_hash):
+    """Warm up the embeddings connection and index once per process and API key."""
+    return warm_up(INDEX_DIR)
+
+def _index_version():
+    """Modification time of the saved index, which changes on every save."""
+    try:
+        return os.path.getmtime(os.path.join(INDEX_DIR, "index.pkl"))
+    except OSError:
+        return None
+
+def _api_key_hash():
+    """Hash of the current API key, so cached clients are keyed without storing it."""
+    return hashlib.sha256(os.getenv("OPENAI_API_KEY", "").encode()).hexdigest()
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def get_chain(index_dir, index_version, api_key_hash):
+    """Build the RAG chain over the saved index once per index version and API key.
+    
+    Returns None if the index can't be loaded. Failed builds are cached too,
+    but a new index version invalidates them.
+    """
+    vectorstore = load_faiss_index(index_dir)
+    return build_rag_chain(vectorstore) if vectorstore else None
+
+def process_uploaded_files(uploaded_files, use_dspy=False, rebuild=False, index_type="auto", nprobe=16):
+    """Process uploaded files and update the RAG chain.
+    
+    Files whose bytes were already indexed are skipped. The rest are parsed
+    straight from their uploaded bytes, in parallel, and their chunks are
+    embedded and indexed in a single pass. The chunks are added to the
+    existing index; with rebuild=True, or if the index can't be updated in
+    place, the index is rebuilt from the chunks it holds plus the new
+    documents. Those chunks keep their embeddings in the embedding cache, so
+    only the new documents are embedded.
+    
+    index_type and nprobe configure the index when it is (re)built; see
+    build_faiss_index.
+    
+    Returns:
+        tuple: Names of the files that yielded new documents, and names of
+            the files that were already indexed
+    """
+    # A 16-byte BLAKE2b digest is plenty to recognise repeat uploads
+    uploads = {}
+    for uploaded_file in uploaded_files:
+        data = uploaded_file.getvalue()
+        uploads.setdefault(hashlib.blake2b(data, digest_size=16).hexdigest(), (uploaded_file.name, data))
+    ingested = st.session_state["ingested_hashes"]
+    if not os.path.exists(os.path.join(INDEX_DIR, "index.pkl")):
+        ingested.clear()  # The index was removed since they were recorded
+    already_indexed = {name for upload_hash, (name, _) in uploads.items() if upload_hash in ingested}
+    uploads = {upload_hash: upload for upload_hash, upload in uploads.items() if upload_hash not in ingested}
+    
+    if not uploads:
+        # The index already has everything; only the chain may be missing
+        if st.session_state["chain"] is None:
+            st.session_state["chain"] = get_chain(INDEX_DIR, _index_version(), _api_key_hash())
+        return set(), already_indexed
+    
+    upload_hashes = list(uploads)
+    names = [name for name, _ in uploads.values()]
+    contents = [data for _, data in uploads.values()]
+    for name in names:
+        logger.debug(f"Processing file: {name}")
+    
+    # Parse the uploads in memory, in parallel processes when there are several
+    loaded = parse_files(load_documents_from_bytes, names, contents)
+    for upload_hash, docs in zip(upload_hashes, loaded):
+        for doc in docs:
+            doc.metadata["upload_hash"] = upload_hash
+    # Drop duplicate uploads of the same content
+    documents = list({doc.metadata["hash"]: doc for docs in loaded for doc in docs}.values())
+    
+    if not documents:
+        return set(), already_indexed
+    
+    # Store documents in session state; re-uploads replace the earlier copy
+    for doc in documents:
+        st.session_state["documents"].add(doc.metadata["hash"], doc)
+    
+    # Add to the existing index; memory-mapped indexes are read-only
+    vectorstore = None if rebuild else load_faiss_index(INDEX_DIR, mmap=False)
+    if vectorstore:
+        try:
+            vectorstore = update_faiss_index(vectorstore, documents, [], INDEX_DIR)
+            ingested.update(upload_hashes)
+        except Exception as e:
+            logger.warning(f"Could not update index, rebuilding: {e}")
+            vectorstore = None
+    
+    # Build index; the saved index replaces the old one only once it's complete
+    if vectorstore is None:
+        # Keep everything the saved index holds, not just the (bounded) session
+        # documents. Its chunks are no longer than the chunk size, so they are
+        # not split again. The read-only copy is unaffected by a failed update.
+        previous = load_faiss_index(INDEX_DIR)
+        indexed_chunks = [
+            previous.docstore.search(doc_id) for doc_id in previous.index_to_docstore_id.values()
+        ] if previous else []
+        vectorstore = build_faiss_index(indexed_chunks + documents, INDEX_DIR, index_type=index_type, nprobe=nprobe)
         if vectorstore:
-            st.session_state["chain"] = build_rag_chain(vectorstore)
-            return True
-        return False
+            if not previous:
+                ingested.clear()  # Nothing could be kept from the old index
+            ingested.update(upload_hashes)
+    
+    if vectorstore:
+        _save_ingested_hashes(ingested)
+        # Serve queries from a memory-mapped copy, so the in-memory index used
+        # for building and updating can be freed and sessions share its pages
+        st.session_state["chain"] = (
+            get_chain(INDEX_DIR, _index_version(), _api_key_hash()) or build_rag_chain(vectorstore)
+        )
+        return {doc.metadata["source"] for doc in documents}, already_indexed
+    return set(), already_indexed
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def build_iep_zip(iep_results):
+    """Bundle IEP results into a ZIP with one JSON file per IEP.
+    
+    Cached by the results, so reruns reuse the archive until they change.
+    """
+    zip_buffer = io.BytesIO()
+    # Stored rather than deflated: the files are small text and the archive
+    # is only a download bundle
+    with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_STORED) as zip_file:
+        for idx, iep in enumerate(iep_results):
+            json_data = orjson.dumps(iep, option=orjson.OPT_INDENT_2)
+            zip_file.writestr(f"IEP_{idx + 1}.json", json_data)
+    return zip_buffer.getvalue()
+
+# Lesson plan PDF styles, built once rather than per render
+_PDF_STYLES = getSampleStyleSheet()
+_PDF_TITLE_STYLE = ParagraphStyle(
+    'CustomTitle',
+    parent=_PDF_STYLES['Heading1'],
+    fontSize=24,
+    spaceAfter=30
+)
+_PDF_HEADING_STYLE = _PDF_STYLES['Heading2']
+_PDF_BODY_STYLE = _PDF_STYLES['Normal']
+# Plan fields that are metadata rather than PDF sections
+_PDF_SKIP_SECTIONS = frozenset(('timeframe', 'timestamp', 'source_iep', 'quality_score'))
+
+@st.cache_resource
+def get_render_executor():
+    """Threads that render lesson plan PDFs off the script thread, shared per process."""
+    return ThreadPoolExecutor(max_workers=2)
+
+def render_lesson_plan_pdf(plan_key, plan_data):
+    """Return a future for a plan's PDF, starting the render if needed.
+    
+    Futures are kept per plan in session state, so each plan is rendered once
+    and reruns reuse its bytes.
+    """
+    pdfs = st.session_state["lesson_plan_pdfs"]
+    if plan_key not in pdfs:
+        pdfs.add(plan_key, get_render_executor().submit(create_lesson_plan_pdf, plan_data))
+    return pdfs[plan_key]
+
+def lesson_plan_pdf_button(future, label, file_name, key):
+    """Offer a plan's PDF once rendered, and a disabled button until then.
+    
+    Run as a fragment that polls while the PDF renders and draws the enabled
+    button itself once it is ready, so nothing outside the fragment reruns.
+    The next page rerun draws it without a timer.
+    """
+    if not future.done():
+        st.download_button(label=label, data=b"", file_name=file_name, mime="application/pdf",
+                           key=key, disabled=True, help="Rendering PDF...")
+        return
+    try:
+        pdf = future.result()
+    except Exception as e:
+        st.error(f"Could not create the PDF: {e}")
+        return
+    st.download_button(label=label, data=pdf, file_name=file_name,
+                       mime="application/pdf", key=key)
 
 def create_lesson_plan_pdf(plan_data):
     """Create a formatted PDF from lesson plan data."""
     buffer = io.BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=letter)
-    styles = getSampleStyleSheet()
     story = []
 
     # Title
-    title_style = ParagraphStyle(
-        'CustomTitle',
-        parent=styles['Heading1'],
-        fontSize=24,
-        spaceAfter=30
-    )
-    story.append(Paragraph(f"Lesson Plan - {plan_data['timeframe'].title()}", title_style))
+    story.append(Paragraph(f"Lesson Plan - {plan_data['timeframe'].title()}", _PDF_TITLE_STYLE))
     story.append(Spacer(1, 12))
 
     # Sections
     for section, content in plan_data.items():
-        if section not in ['timeframe', 'timestamp', 'source_iep', 'quality_score']:
-            # Section header
-            story.append(Paragraph(section.replace('_', ' ').title(), styles['Heading2']))
-            story.append(Spacer(1, 6))
-            
-            # Section content
-            if isinstance(content, list):
-                for item in content:
-                    story.append(Paragraph(f"• {item}", styles['Normal']))
-            else:
-                story.append(Paragraph(str(content), styles['Normal']))
-            story.append(Spacer(1, 12))
+        if section in _PDF_SKIP_SECTIONS:
+            continue
+        
+        # Section header
+        story.append(Paragraph(section.replace('_', ' ').title(), _PDF_HEADING_STYLE))
+        story.append(Spacer(1, 6))
+        
+        # Section content
+        if isinstance(content, list):
+            for item in content:
+                story.append(Paragraph(f"• {item}", _PDF_BODY_STYLE))
+        else:
+            story.append(Paragraph(str(content), _PDF_BODY_STYLE))
+        story.append(Spacer(1, 12))
 
     # Build PDF
     doc.build(story)
-    return buffer
+    return buffer.getvalue()
+
+def clear_documents():
+    """Forget the session's documents and remove the index."""
+    st.session_state["documents_processed"] = False
+    st.session_state["chain"] = None
+    get_chain.clear()
+    st.session_state["documents"] = SessionLRU(MAX_SESSION_DOCUMENTS)  # Clear documents
+    st.session_state["iep_results"] = []  # Clear IEP results
+    if os.path.exists(INDEX_DIR):
+        shutil.rmtree(INDEX_DIR)
+    st.session_state["ingested_hashes"].clear()
+    _save_ingested_hashes(st.session_state["ingested_hashes"])
+    st.session_state["handled_uploads"].clear()
+
+def clear_chat():
+    """Forget the chat history."""
+    st.session_state.messages = []
+
+def clear_iep_results():
+    """Forget the generated IEPs."""
+    st.session_state["iep_results"] = []
 
 st.title("Educational Assistant with GPT-4o Mini")
 
@@ -121,11 +342,34 @@ with st.sidebar:
     api_key = st.text_input("OpenAI API Key", type="password")
     if api_key:
         os.environ["OPENAI_API_KEY"] = api_key
+        # Make the first query skip connection setup and index loading (RAG_WARMUP=0 disables)
+        if os.getenv("RAG_WARMUP", "1") != "0":
+            warmup(_api_key_hash())
+        # Serve the index saved by an earlier run without waiting for uploads
+        if st.session_state["chain"] is None and _index_version() is not None:
+            st.session_state["chain"] = get_chain(INDEX_DIR, _index_version(), _api_key_hash())
+            st.session_state["documents_processed"] = st.session_state["chain"] is not None
 
     if not api_key:
         st.error("Please provide your OpenAI API key.")
 
     use_dspy = st.checkbox("Use DSPy Processing", value=False)
+    
+    with st.expander("Index Settings"):
+        index_type = st.selectbox(
+            "Index type",
+            ["auto", "ivfpq", "hnsw", "ivfflat", "ivfsq8", "ivfsqfp16", "binary"],
+            help="auto uses HNSW below 50k chunks and compressed IVF-PQ above. "
+                 "ivfsq8/ivfsqfp16 store 8-bit or 16-bit scalar-quantized vectors. "
+                 "Applies when the index is built."
+        )
+        nprobe = st.slider(
+            "IVF lists searched per query (nprobe)",
+            min_value=1, max_value=128, value=16,
+            help="Higher values improve recall at the cost of latency. "
+                 "Applies when the index is built; the FAISS_NPROBE environment "
+                 "variable overrides it when an index is loaded."
+        )
 
     uploaded_files = st.file_uploader(
         "Upload educational documents",
@@ -133,23 +377,37 @@ with st.sidebar:
         accept_multiple_files=True
     )
 
-    if uploaded_files and not st.session_state["documents_processed"]:
+    # Only files added to the uploader since the last pass need processing;
+    # they are added to the loaded index rather than rebuilding it
+    new_files = [
+        file for file in uploaded_files or []
+        if file.file_id not in st.session_state["handled_uploads"]
+    ]
+    if new_files:
         processing_success = True  # Track overall success
         with st.spinner("Processing documents..."):
             st.write("### Processing Files")
-            for file in uploaded_files:
-                status_container = st.empty()
-                status_container.info(f"Processing {file.name}...")
-                
-                try:
-                    success = process_uploaded_file(file, use_dspy=use_dspy)
-                    if success:
-                        status_container.success(f"Successfully processed {file.name}")
+            status_containers = {}
+            for file in new_files:
+                status_containers[file.name] = st.empty()
+                status_containers[file.name].info(f"Processing {file.name}...")
+            
+            try:
+                processed, already_indexed = process_uploaded_files(
+                    new_files, use_dspy=use_dspy, index_type=index_type, nprobe=nprobe
+                )
+                for name, status_container in status_containers.items():
+                    if name in processed:
+                        status_container.success(f"Successfully processed {name}")
+                    elif name in already_indexed:
+                        status_container.info(f"{name} is already indexed")
                     else:
-                        status_container.error(f"Failed to process {file.name}")
-                except Exception as e:
-                    status_container.error(f"Error processing {file.name}: {str(e)}")
+                        status_container.error(f"No new text could be extracted from {name}")
+            except Exception as e:
+                for name, status_container in status_containers.items():
+                    status_container.error(f"Error processing {name}: {str(e)}")
             
+            st.session_state["handled_uploads"].update(file.file_id for file in new_files)
             if processing_success:
                 st.session_state["documents_processed"] = True
                 st.success("All documents processed successfully!")
@@ -157,14 +415,9 @@ with st.sidebar:
                 st.error("Error processing some documents.")
 
     if st.session_state["documents_processed"]:
-        if st.button("Clear Documents"):
-            st.session_state["documents_processed"] = False
-            st.session_state["chain"] = None
-            st.session_state["documents"] = []  # Clear documents
-            st.session_state["iep_results"] = []  # Clear IEP results
-            if os.path.exists(INDEX_DIR):
-                shutil.rmtree(INDEX_DIR)
-            st.experimental_rerun()
+        # Cleared in the click's callback, before the rerun renders anything,
+        # so no second rerun is needed
+        st.button("Clear Documents", on_click=clear_documents)
 
     st.title("System Status")
     if st.button("Check System Health"):
@@ -183,14 +436,20 @@ with st.sidebar:
             st.write("- Directories:", "Created" if status["directories"] else "Failed")
             st.write("- Document Loading:", "Working" if status["document_loading"] else "Failed")
             st.write("- Vector Store:", "Operational" if status["vectorstore"] else "Failed")
-            st.write("- RAG Chain:", "Functional" if status["chain"] else "Failed")
+            st.write("- Retrieval:", "Functional" if status["retrieval"] else "Failed")
             st.write("- DSPy Integration:", "Available" if status["dspy"] else "Not Available")
 
 # Create tabs
 tab1, tab2, tab3, tab4 = st.tabs(["Document Q&A", "Chat", "IEP Generation", "Lesson Plans"])
 
+# The Q&A, Chat and Lesson Plan tabs are fragments, so interacting with one
+# reruns only that tab. The IEP tab reruns the app, since the Lesson Plans tab
+# lists its results.
+
 # Document Q&A Tab
-with tab1:
+@st.fragment
+def render_qa_tab():
+    """Render the Document Q&A tab."""
     st.header("Document Q&A")
 
     query = st.text_area(
@@ -201,21 +460,22 @@ with tab1:
 
     if query:
         if st.session_state["chain"]:
+            st.write("### Response")
+            placeholder = st.empty()
             with st.spinner("Generating response..."):
                 try:
-                    start_time = time.time()
-                    
-                    # Get response
-                    chain_response = st.session_state["chain"]({"query": query})
-                    end_time = time.time()
+                    # Stream the answer into the placeholder as tokens arrive
+                    chain_response, timings = run_rag_query(
+                        st.session_state["chain"], query, on_text=placeholder.markdown
+                    )
+                    st.session_state["last_timings"] = timings
                     
                     # Extract answer and sources
                     answer = chain_response.get('result', '')
                     sources = chain_response.get('source_documents', [])
                     
-                    # Display response
-                    st.write("### Response")
-                    st.write(answer)
+                    # Display the final response
+                    placeholder.markdown(answer)
                     
                     # Display sources
                     with st.expander("View Retrieved Context"):
@@ -231,8 +491,11 @@ with tab1:
                             st.write(f"Chain type: {type(st.session_state['chain'])}")
                             st.write(f"Response type: {type(chain_response)}")
                             st.write(f"Response keys: {chain_response.keys() if isinstance(chain_response, dict) else 'Not a dict'}")
+                        
+                        st.write("Stage timings (ms):")
+                        st.json({label: round(ms, 1) for label, ms in timings.items()})
                     
-                    st.write(f"Response time: {end_time - start_time:.2f} seconds")
+                    st.write(f"Response time: {timings['total'] / 1000:.2f} seconds")
                     
                 except Exception as e:
                     st.error(f"Error generating response: {str(e)}")
@@ -240,8 +503,48 @@ with tab1:
         else:
             st.warning("Please upload documents first!")
 
+with tab1:
+    render_qa_tab()
+
 # Chat Interface Tab
-with tab2:
+def _show_chat_sources(sources):
+    """Show the context an answer was generated from."""
+    with st.expander("View Source Context"):
+        if sources:
+            for i, doc in enumerate(sources, 1):
+                st.write(f"Source {i}:")
+                st.write(doc.page_content)
+                st.write("---")
+        else:
+            st.write("No source documents were retrieved.")
+
+def _answer_chat_batch(prompts):
+    """Answer several questions concurrently and add each turn to the chat."""
+    with st.spinner("Thinking..."):
+        results = submit_rag_queries(st.session_state["chain"], prompts)
+    
+    for prompt, result in zip(prompts, results):
+        st.session_state.messages.append({"role": "user", "content": prompt})
+        with st.chat_message("user"):
+            st.markdown(prompt)
+        
+        with st.chat_message("assistant"):
+            if isinstance(result, Exception):
+                error_message = f"Error generating response: {str(result)}"
+                st.session_state.messages.append({"role": "assistant", "content": error_message})
+                st.error(error_message)
+                continue
+            
+            chain_response, timings = result
+            st.session_state["last_timings"] = timings
+            response = chain_response.get('result', '')
+            st.session_state.messages.append({"role": "assistant", "content": response})
+            st.markdown(response)
+            _show_chat_sources(chain_response.get('source_documents', []))
+
+@st.fragment
+def render_chat_tab():
+    """Render the Chat tab."""
     st.header("Chat Interface")
     
     for message in st.session_state.messages:
@@ -249,8 +552,13 @@ with tab2:
             st.markdown(message["content"])
 
     if prompt := st.chat_input("Ask a question..."):
+        # With BATCH_CHAT=1, each line of a multi-line message is a separate
+        # question, and they are answered concurrently
+        prompts = [line.strip() for line in prompt.splitlines() if line.strip()]
         if not st.session_state.get("documents_processed"):
             st.error("Please upload documents first!")
+        elif BATCH_CHAT and len(prompts) > 1:
+            _answer_chat_batch(prompts)
         else:
             # Add user message
             st.session_state.messages.append({"role": "user", "content": prompt})
@@ -259,35 +567,34 @@ with tab2:
 
             # Generate response
             with st.chat_message("assistant"):
+                placeholder = st.empty()
                 with st.spinner("Thinking..."):
                     try:
-                        # Use the call method instead of run
-                        chain_response = st.session_state["chain"]({"query": prompt})
+                        # Runs on the chain's shared event loop, so concurrent chats share
+                        # one pool of connections instead of each blocking on its own
+                        chain_response, timings = submit_rag_query(
+                            st.session_state["chain"], prompt, on_text=placeholder.markdown
+                        )
+                        st.session_state["last_timings"] = timings
                         response = chain_response.get('result', '')
                         sources = chain_response.get('source_documents', [])
                         
                         # Add response to messages
                         st.session_state.messages.append({"role": "assistant", "content": response})
-                        st.markdown(response)
+                        placeholder.markdown(response)
                         
                         # Show sources in expander
-                        with st.expander("View Source Context"):
-                            if sources:
-                                for i, doc in enumerate(sources, 1):
-                                    st.write(f"Source {i}:")
-                                    st.write(doc.page_content)
-                                    st.write("---")
-                            else:
-                                st.write("No source documents were retrieved.")
+                        _show_chat_sources(sources)
                                 
                     except Exception as e:
                         error_message = f"Error generating response: {str(e)}"
                         st.session_state.messages.append({"role": "assistant", "content": error_message})
                         st.error(error_message)
 
-    if st.button("Clear Chat History"):
-        st.session_state.messages = []
-        st.experimental_rerun()
+    st.button("Clear Chat History", on_click=clear_chat)
+
+with tab2:
+    render_chat_tab()
 
 # IEP Generation Tab
 with tab3:
@@ -310,25 +617,31 @@ with tab3:
                 try:
                     with st.spinner("Generating IEPs... This may take a few minutes."):
                         # Get the pipeline
-                        pipeline = IEPPipeline()
+                        pipeline = get_iep_pipeline(_api_key_hash())
+                        
+                        # Process all documents concurrently and store results
+                        documents = list(st.session_state["documents"].values())
+                        progress_bar = st.progress(0.0, text=f"Processing {len(documents)} documents...")
+                        results = pipeline.process_documents(
+                            documents,
+                            on_progress=lambda done, total: progress_bar.progress(
+                                done / total, text=f"Processed {done} of {total} documents"
+                            )
+                        )
                         
-                        # Process documents and store results
                         iep_results = []
-                        for doc in st.session_state.get("documents", []):
-                            # Add debug print
-                            st.write(f"Processing document: {doc.metadata.get('source', 'Unknown')}")
-                            
-                            result = pipeline.process_documents([doc])
-                            if result:
-                                iep_data = {
-                                    "source": doc.metadata.get("source", "Unknown"),
-                                    "timestamp": datetime.now().isoformat(),
-                                    "content": result[0].page_content,
-                                    "metadata": result[0].metadata
-                                }
-                                iep_results.append(iep_data)
-                                # Add debug print
-                                st.write(f"Successfully processed: {iep_data['source']}")
+                        for doc, result in zip(documents, results):
+                            # Failed extractions come back as the original document
+                            if result.metadata.get("processed_with") != "dspy":
+                                st.write(f"Failed to process: {doc.metadata.get('source', 'Unknown')}")
+                                continue
+                            iep_data = {
+                                "source": doc.metadata.get("source", "Unknown"),
+                                "timestamp": datetime.now().isoformat(),
+                                "content": result.page_content,
+                                "metadata": result.metadata
+                            }
+                            iep_results.append(iep_data)
                         
                         st.session_state["iep_results"] = iep_results
                         st.success(f"Successfully generated {len(iep_results)} IEPs!")
@@ -340,19 +653,9 @@ with tab3:
         with col2:
             if st.session_state["iep_results"]:
                 st.subheader("Bulk Download")
-                # Create a ZIP file containing all IEPs
-                import io
-                import zipfile
-                
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                    for idx, iep in enumerate(st.session_state["iep_results"]):
-                        json_data = json.dumps(iep, indent=2)
-                        zip_file.writestr(f"IEP_{idx + 1}.json", json_data)
-                
                 st.download_button(
                     label="Download All IEPs (ZIP)",
-                    data=zip_buffer.getvalue(),
+                    data=build_iep_zip(st.session_state["iep_results"]),
                     file_name="all_ieps.zip",
                     mime="application/zip"
                 )
@@ -372,7 +675,7 @@ with tab3:
                     st.json(iep['metadata'])
                     
                     # Individual download button
-                    json_data = json.dumps(iep, indent=2)
+                    json_data = orjson.dumps(iep, option=orjson.OPT_INDENT_2)
                     st.download_button(
                         label=f"Download IEP {idx + 1}",
                         data=json_data,
@@ -383,16 +686,16 @@ with tab3:
         
         # Clear results button
         if st.session_state["iep_results"]:
-            if st.button("Clear IEP Results"):
-                st.session_state["iep_results"] = []
-                st.experimental_rerun()
+            st.button("Clear IEP Results", on_click=clear_iep_results)
                 
     else:
         st.warning("Please upload and process documents first!")
         st.info("Once documents are processed, you can generate IEPs here.")
 
 # Lesson Plan Generation Tab
-with tab4:
+@st.fragment
+def render_lesson_plan_tab():
+    """Render the Lesson Plans tab."""
     st.header("Lesson Plan Generation")
     
     # Combined form for all lesson plan generation
@@ -491,11 +794,14 @@ with tab4:
                             }
                             
                             # Generate enhanced plan
-                            pipeline = LessonPlanPipeline()
+                            pipeline = get_lesson_plan_pipeline(_api_key_hash())
                             plan = pipeline.generate_lesson_plan(combined_data, timeframe.lower())
                             
                             if plan:
-                                st.session_state["lesson_plans"].append(plan)
+                                plan_key = str(uuid.uuid4())
+                                st.session_state["lesson_plans"].add(plan_key, plan)
+                                # Start rendering the PDF while the page draws
+                                render_lesson_plan_pdf(plan_key, plan)
                                 st.success(f"Enhanced {timeframe.lower()} lesson plan generated successfully!")
                             
                     except Exception as e:
@@ -505,7 +811,13 @@ with tab4:
     if st.session_state.get("lesson_plans"):
         st.markdown("### Generated Lesson Plans")
         
-        for idx, plan in enumerate(st.session_state["lesson_plans"]):
+        # Queue any missing PDFs up front, so they render while the plans are drawn
+        pdf_futures = {
+            plan_key: render_lesson_plan_pdf(plan_key, plan)
+            for plan_key, plan in st.session_state["lesson_plans"].items()
+        }
+        
+        for idx, (plan_key, plan) in enumerate(st.session_state["lesson_plans"].items()):
             with st.expander(f"{plan['timeframe'].title()} Plan - {plan['subject']}", expanded=True):
                 # Basic info
                 st.markdown(f"**Grade Level**: {plan['grade_level']}")
@@ -538,15 +850,19 @@ with tab4:
                 for mod in plan['modifications']:
                     st.markdown(f"- {mod}")
                 
-                # Download button
-                pdf_buffer = create_lesson_plan_pdf(plan)
-                st.download_button(
+                # Download button; a PDF still rendering reruns just its button
+                # every second, which enables itself once the PDF is ready
+                future = pdf_futures[plan_key]
+                st.fragment(run_every=None if future.done() else 1)(lesson_plan_pdf_button)(
+                    future,
                     label=f"Download {plan['timeframe'].title()} Plan (PDF)",
-                    data=pdf_buffer.getvalue(),
                     file_name=f"lesson_plan_{plan['subject']}_{plan['timeframe']}_{idx + 1}.pdf",
-                    mime="application/pdf"
+                    key=f"download_plan_{plan_key}"
                 )
 
+with tab4:
+    render_lesson_plan_tab()
+
 # Footer
 st.markdown("---")
 st.markdown("Educational Assistant powered by GPT-4o Mini and LangChain")